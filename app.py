@@ -11,18 +11,24 @@ import folium
 from folium.plugins import Draw
 from streamlit_folium import st_folium
 import pandas as pd
+import numpy as np
 import requests
-import json, io, zipfile, tempfile, os, math, time
+import json, io, zipfile, tempfile, os, re, codecs, copy, math, time, hashlib, sqlite3, threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections import OrderedDict
+from itertools import chain
+from functools import partial, cached_property, wraps
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from shapely.geometry import shape
+import shapely
+from shapely.geometry import shape, mapping
 import xml.etree.ElementTree as ET
 import openpyxl
 from openpyxl.styles import PatternFill, Font, Alignment
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.utils import get_column_letter
 
-st.set_page_config(page_title="AgroSense NDVI", page_icon="🌿",
-                   layout="wide", initial_sidebar_state="expanded")
-st.markdown("""
+PAGE_CSS = """
 <style>
 @import url('https://fonts.googleapis.com/css2?family=Space+Mono:wght@400;700&family=Syne:wght@700;800&display=swap');
 html,body,[class*="css"]{font-family:'Space Mono',monospace;}
@@ -39,7 +45,7 @@ h1,h2,h3{font-family:'Syne',sans-serif;color:#4ade80;}
 .stButton>button{background:#4ade80;color:#0a0e0a;border:none;font-family:'Space Mono',monospace;font-weight:700;border-radius:6px;width:100%;}
 .stButton>button:hover{background:#22c55e;}
 </style>
-""", unsafe_allow_html=True)
+"""
 
 # ── Kimlik ────────────────────────────────────────────────────
 SH_CLIENT_ID     = "sh-645dcab9-79b1-42a2-9d89-edee62b45fe1"
@@ -50,99 +56,339 @@ CDSE_STAC        = "https://catalogue.dataspace.copernicus.eu/stac/search"
 OPENEO_URL       = "https://openeo.dataspace.copernicus.eu"
 
 # ── Session state ─────────────────────────────────────────────
-for k, v in {
-    "features": [], "selected_ids": [], "ndvi_results": {},
+SESSION_DEFAULTS = {
+    "features": [], "selected_ids": [], "ndvi_results": None,
     "ndvi_dates": [], "active_date": None,
-    "map_center": [39.0, 35.0], "map_zoom": 6,
+    "map_center": [39.0, 35.0], "map_zoom": 6, "map_view": None,
     "date_warnings": {}, "last_draw_count": 0,
-    "do_select_all": False,
-}.items():
-    if k not in st.session_state:
-        st.session_state[k] = v
+    "do_select_all": False, "ndvi_method": None,
+    "ndvi_epoch": 0, "ndvi_ver": {},
+}
+
+# ── Ölçüm: aşama süreleri, HTTP baytları, önbellek isabeti ──
+class Metrics:
+    """
+    Süreç geneli aşama ölçümleri (iş parçacığı güvenli). Aşama başına:
+    çağrı, hata, toplam/en uzun süre, sunucu bekleme (HTTP yanıt başlığına
+    kadar), gönderilen/alınan bayt, parsel sayısı. İç içe aşamalar üsttekinde
+    de sayılır; HTTP baytları o iş parçacığında açık olan en içteki aşamaya yazılır.
+    """
+    FIELDS = ("calls", "errors", "secs", "max_secs", "wait_secs", "bytes_out", "bytes_in", "items")
+
+    def __init__(self):
+        self.lock = threading.Lock(); self.local = threading.local()
+        self.stages = {}; self.hits = {}; self.since = time.time()
+
+    def add(self, name, **vals):
+        with self.lock:
+            rec = self.stages.setdefault(name, dict.fromkeys(self.FIELDS, 0))
+            for k, v in vals.items():
+                rec[k] = max(rec[k], v) if k == "max_secs" else rec[k] + v
+
+    def hit(self, name, ok):
+        """Önbellek dışı isabet sayacı (ör. oturum memo'su)"""
+        with self.lock:
+            h = self.hits.setdefault(name, [0, 0]); h[0 if ok else 1] += 1
+
+    @contextmanager
+    def stage(self, name, items=0):
+        """with metrics().stage("x") as rec: ... — rec'e ek sayaç yazılabilir (items, bytes_in...)"""
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(name); rec = {"items": items}; err = 0
+        t0 = time.perf_counter()
+        try: yield rec
+        except Exception:
+            err = 1; raise
+        finally:
+            dt = time.perf_counter() - t0; stack.pop()
+            self.add(name, calls=1, errors=err, secs=dt, max_secs=dt, **rec)
+
+    def http(self, r, *args, **kwargs):
+        """requests yanıt kancası — istek/yanıt gövdesi baytları ve sunucu bekleme süresi"""
+        stack = getattr(self.local, "stack", None)
+        body = r.request.body or b""
+        cl = r.headers.get("Content-Length")
+        size = int(cl) if cl else (0 if kwargs.get("stream") else len(r.content))
+        self.add(stack[-1] if stack else "http", wait_secs=r.elapsed.total_seconds(),
+                 bytes_out=len(body.encode() if isinstance(body, str) else body), bytes_in=size)
+
+    def snapshot(self, caches=None):
+        """caches: {ad: (isabet, ıska)} — JSON'a yazılabilir anlık görüntü"""
+        with self.lock:
+            stages = {k: dict(v) for k, v in sorted(self.stages.items())}
+            hm = {**{k: tuple(v) for k, v in self.hits.items()}, **(caches or {})}
+        return {"since": datetime.fromtimestamp(self.since).isoformat(timespec="seconds"),
+                "uptime_s": round(time.time() - self.since, 1), "stages": stages,
+                "caches": {k: {"hits": h, "misses": m, "ratio": round(h / (h + m), 4) if h + m else None}
+                           for k, (h, m) in sorted(hm.items())}}
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear(); self.hits.clear(); self.since = time.time()
+
+@st.cache_resource(show_spinner=False)
+def metrics():
+    return Metrics()
+
+def stage(name, items=0):
+    return metrics().stage(name, items)
+
+def timed(name, items=None, size=None):
+    """
+    Fonksiyonu aşama olarak ölç. items(*args, **kw) → parsel sayısı,
+    size(sonuç) → üretilen bayt (export çıktısı vb.)
+    """
+    def deco(fn):
+        @wraps(fn)
+        def run(*args, **kwargs):
+            with stage(name, items(*args, **kwargs) if items else 0) as rec:
+                out = fn(*args, **kwargs)
+                if size: rec["bytes_out"] = size(out)
+                return out
+        return run
+    return deco
+
+def http_hooks():
+    return {"response": metrics().http}
+
+def _metric_caches():
+    return {"stac_scene": scene_cache(), "ndvi_mem": ndvi_mem_cache(),
+            "ndvi_disk": get_ndvi_cache(), "parcel_index": parcel_index_cache()}
+
+def metrics_snapshot():
+    """Aşamalar + paylaşılan önbelleklerin isabet oranları"""
+    return metrics().snapshot({k: (c.hits, c.misses) for k, c in _metric_caches().items() if c})
+
+def metrics_reset():
+    metrics().reset()
+    for c in filter(None, _metric_caches().values()):
+        with c.lock: c.hits = c.misses = 0
+
+# Prometheus metin biçimi: alan → (metrik, tür, açıklama)
+PROM_FIELDS = {
+    "calls":     ("agrosense_stage_calls_total", "counter", "Aşama çağrı sayısı"),
+    "errors":    ("agrosense_stage_errors_total", "counter", "Hata ile biten çağrılar"),
+    "secs":      ("agrosense_stage_seconds_total", "counter", "Toplam duvar saati süresi"),
+    "max_secs":  ("agrosense_stage_max_seconds", "gauge", "En uzun tek çağrı"),
+    "wait_secs": ("agrosense_stage_wait_seconds_total", "counter", "HTTP yanıt başlığına kadar bekleme"),
+    "bytes_out": ("agrosense_stage_sent_bytes_total", "counter", "Gönderilen / üretilen bayt"),
+    "bytes_in":  ("agrosense_stage_received_bytes_total", "counter", "Alınan / okunan bayt"),
+    "items":     ("agrosense_stage_items_total", "counter", "İşlenen parsel (veya satır) sayısı"),
+}
+
+def _prom_label(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus_text(snap):
+    """metrics_snapshot() → Prometheus exposition (text 0.0.4)"""
+    out = []
+    for f, (name, kind, help_) in PROM_FIELDS.items():
+        out += [f"# HELP {name} {help_}", f"# TYPE {name} {kind}"]
+        out += [f'{name}{{stage="{_prom_label(st_)}"}} {rec[f]:.6g}' for st_, rec in snap["stages"].items()]
+    for key, kind, help_ in (("hits", "counter", "Önbellek isabeti"), ("misses", "counter", "Önbellek ıskası")):
+        name = f"agrosense_cache_{key}_total"
+        out += [f"# HELP {name} {help_}", f"# TYPE {name} {kind}"]
+        out += [f'{name}{{cache="{_prom_label(c)}"}} {v[key]}' for c, v in snap["caches"].items()]
+    out += ["# HELP agrosense_metrics_uptime_seconds Son sıfırlamadan beri geçen süre",
+            "# TYPE agrosense_metrics_uptime_seconds gauge", f"agrosense_metrics_uptime_seconds {snap['uptime_s']}"]
+    return "\n".join(out) + "\n"
 
 # ── Token (OAuth2 — requests ile, cache'li) ───────────────────
 @st.cache_data(ttl=3000, show_spinner=False)
+@timed("token")
 def get_token():
     r = requests.post(CDSE_TOKEN_URL, data={
         "grant_type":    "client_credentials",
         "client_id":     SH_CLIENT_ID,
         "client_secret": SH_CLIENT_SECRET,
-    }, timeout=15)
+    }, timeout=15, hooks=http_hooks())
     r.raise_for_status()
     return r.json()["access_token"]
 
+# ── Süreç geneli paylaşılan önbellek (tüm oturumlar) ─────────
+class SharedCache:
+    """
+    İş parçacığı güvenli TTL + LRU önbellek; aynı anahtar için eşzamanlı
+    hesaplamaları tekilleştirir (ilk çağıran hesaplar, diğerleri bekler).
+    """
+    def __init__(self, max_items, ttl):
+        self.max_items = max_items; self.ttl = ttl
+        self.data = OrderedDict(); self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0; self.misses = 0
+
+    def _get(self, key):
+        ent = self.data.get(key)
+        if ent is None: return None
+        if ent[0] < time.time():
+            del self.data[key]; return None
+        self.data.move_to_end(key)
+        return ent
+
+    def get_many(self, keys):
+        """Returns: {key: value} — sadece geçerli kayıtlar"""
+        out = {}
+        with self.lock:
+            for k in keys:
+                ent = self._get(k)
+                if ent is not None: out[k] = ent[1]
+            self.hits += len(out); self.misses += len(keys) - len(out)
+        return out
+
+    def put_many(self, items):
+        exp = time.time() + self.ttl
+        with self.lock:
+            for k, v in items.items():
+                self.data[k] = (exp, v); self.data.move_to_end(k)
+            while len(self.data) > self.max_items:
+                self.data.popitem(last=False)
+
+    def compute(self, key, fn, store=True):
+        """Önbellekte varsa döndür; yoksa fn() — aynı anahtar için tek çağrı."""
+        with self.lock:
+            ent = self._get(key) if store else None
+            if ent is not None:
+                self.hits += 1; return ent[1]
+            fut = self.inflight.get(key); owner = fut is None
+            if owner:
+                fut = self.inflight[key] = Future(); self.misses += 1
+            else: self.hits += 1
+        if not owner: return fut.result()
+        try:
+            val = fn()
+            if store: self.put_many({key: val})
+            fut.set_result(val); return val
+        except BaseException as e:
+            fut.set_exception(e); raise
+        finally:
+            with self.lock: self.inflight.pop(key, None)
+
+    def clear(self):
+        with self.lock: self.data.clear()
+
+@st.cache_resource(show_spinner=False)
+def scene_cache():
+    """STAC sorgusu (bbox + zaman penceresi) → sahne listesi; 1 saat"""
+    return SharedCache(max_items=512, ttl=3600)
+
+@st.cache_resource(show_spinner=False)
+def ndvi_mem_cache():
+    """(geometri özeti, sahne tarihi, parametre) → NDVI; 6 saat"""
+    return SharedCache(max_items=500_000, ttl=6 * 3600)
+
 # ── STAC: ±15 gün içinde en yakın bulutsuz sahne ─────────────
-def find_nearest_scene(bbox, target_date_str, days=15):
+STAC_MAX_CC    = 70   # kabul edilen en yüksek bulut oranı (%)
+STAC_MAX_PAGES = 40   # sayfalama emniyet sınırı
+
+@timed("stac.search")
+def stac_search(body):
     """
-    CDSE STAC Catalog API ile en yakın Sentinel-2 sahnesini bul.
-    Hızlı: sadece metadata, veri indirme yok.
-    bbox: [west, south, east, north]
+    CDSE STAC araması — `next` linklerini izleyerek tüm sayfaları toplar.
+    cql2 filtresi reddedilirse filtresiz tekrar dener (bulut filtresi yerelde).
+    STAC_MAX_PAGES aşılırsa eksik katalog döndürmek yerine hata verir
+    (çağıran tarih bazlı dar sorgulara düşer).
     """
     token = get_token()
-    d     = datetime.strptime(target_date_str, "%Y-%m-%d")
-    start = (d - timedelta(days=days)).strftime("%Y-%m-%dT00:00:00Z")
-    end   = (d + timedelta(days=days)).strftime("%Y-%m-%dT23:59:59Z")
+    hdr   = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    hooks = http_hooks()
+    r = requests.post(CDSE_STAC, json=body, headers=hdr, timeout=20, hooks=hooks)
+    if not r.ok:
+        # fallback: filtre olmadan dene
+        body = {k: v for k, v in body.items() if k not in ("filter","filter-lang")}
+        with stage("stac.fallback"):
+            r = requests.post(CDSE_STAC, json=body, headers=hdr, timeout=20, hooks=hooks)
+    items = []
+    for _ in range(STAC_MAX_PAGES):
+        if not r.ok:
+            raise RuntimeError(f"STAC {r.status_code}: {r.text[:200]}")
+        js    = r.json()
+        feats = js.get("features", [])
+        items += feats
+        nxt = next((l for l in js.get("links", []) if l.get("rel") == "next"), None)
+        if not nxt or not feats: return items
+        if nxt.get("method", "GET").upper() == "POST":
+            nb = nxt.get("body") or {}
+            nb = {**body, **nb} if nxt.get("merge") or not nb else nb
+            r  = requests.post(nxt["href"], json=nb, headers=hdr, timeout=20, hooks=hooks)
+        else:
+            r  = requests.get(nxt["href"], headers=hdr, timeout=20, hooks=hooks)
+    raise RuntimeError(f"STAC sonucu {STAC_MAX_PAGES} sayfayı aştı ({len(items)} sahne); aralık daraltılmalı")
+
+def _scene_cc(item):
+    cc = item["properties"].get("eo:cloud_cover")
+    return cc if isinstance(cc, (int, float)) else 0
+
+def pick_nearest(items, target_date_str, days=15):
+    """Hazır sahne listesinden hedef tarihe en yakın (eşitse en az bulutlu) sahne."""
+    d = datetime.strptime(target_date_str, "%Y-%m-%d")
+    best = None; best_key = None
+    for it in items:
+        dt  = datetime.strptime(it["properties"]["datetime"][:10], "%Y-%m-%d")
+        gap = abs(dt - d)
+        if gap > timedelta(days=days): continue
+        key = (gap, _scene_cc(it))
+        if best_key is None or key < best_key:
+            best, best_key = it, key
+    if best is None:
+        return None, None
+    return best["properties"]["datetime"][:10], best
+
+@timed("stac.resolve", items=lambda bbox, dates, *a, **k: len(dates))
+def resolve_scenes(bbox, target_dates, days=15):
+    """
+    Tüm hedef tarihler için tek STAC taraması:
+    [min tarih − days, max tarih + days] aralığı bir kez sorgulanır (tüm sayfalar),
+    her tarih için en yakın sahne yerelde seçilir.
+    Returns: {target_date: (actual_date, scene)}
+    """
+    if not target_dates: return {}
+    ds    = [datetime.strptime(t, "%Y-%m-%d") for t in target_dates]
+    start = (min(ds) - timedelta(days=days)).strftime("%Y-%m-%dT00:00:00Z")
+    end   = (max(ds) + timedelta(days=days)).strftime("%Y-%m-%dT23:59:59Z")
 
     body = {
         "collections": ["SENTINEL-2"],
         "bbox":        bbox,
         "datetime":    f"{start}/{end}",
-        "limit":       50,
-        "filter":      {"op":"lte","args":[{"property":"eo:cloud_cover"},70]},
+        "limit":       100,
+        "filter":      {"op":"lte","args":[{"property":"eo:cloud_cover"},STAC_MAX_CC]},
         "filter-lang": "cql2-json",
     }
-    r = requests.post(CDSE_STAC, json=body,
-                      headers={"Authorization": f"Bearer {token}",
-                                "Content-Type": "application/json"},
-                      timeout=20)
-    if not r.ok:
-        # fallback: filtre olmadan dene
-        body2 = {k: v for k, v in body.items() if k not in ("filter","filter-lang")}
-        r = requests.post(CDSE_STAC, json=body2,
-                          headers={"Authorization": f"Bearer {token}",
-                                    "Content-Type": "application/json"},
-                          timeout=20)
-    if not r.ok:
-        raise RuntimeError(f"STAC {r.status_code}: {r.text[:200]}")
-
-    items = r.json().get("features", [])
-    if not items:
-        return None, None
-
-    # En yakın tarihi seç
-    items.sort(key=lambda x: abs(
-        datetime.strptime(x["properties"]["datetime"][:10], "%Y-%m-%d") - d))
-    best = items[0]
-    actual_date = best["properties"]["datetime"][:10]
-    return actual_date, best
+    # Filtre düştüyse (fallback) bulut eşiğini burada uygula
+    # Aynı sorgu tüm oturumlarda paylaşılır; eşzamanlı aynı sorgu tek istek olur
+    key   = json.dumps(body, sort_keys=True)
+    items = [it for it in scene_cache().compute(key, lambda: stac_search(body))
+             if _scene_cc(it) <= STAC_MAX_CC]
+    return {t: pick_nearest(items, t, days) for t in target_dates}
+
+@timed("stac.nearest")
+def find_nearest_scene(bbox, target_date_str, days=15):
+    """
+    CDSE STAC Catalog API ile en yakın Sentinel-2 sahnesini bul.
+    Hızlı: sadece metadata, veri indirme yok.
+    bbox: [west, south, east, north]
+    """
+    return resolve_scenes(bbox, [target_date_str], days)[target_date_str]
 
 # ── OpenEO: tek gün, tüm parseller batch ─────────────────────
 @st.cache_resource(show_spinner=False)
+@timed("openeo.connect")
 def get_openeo():
     import openeo
-    conn = openeo.connect(OPENEO_URL)
+    sess = requests.Session(); sess.hooks["response"].append(metrics().http)   # bayt / bekleme
+    conn = openeo.connect(OPENEO_URL, session=sess)
     conn.authenticate_oidc_client_credentials(
         client_id=SH_CLIENT_ID, client_secret=SH_CLIENT_SECRET)
     return conn
 
-def fetch_ndvi_for_date(features, actual_date_str):
-    """
-    Kesin tarihi bilinen bir gün için tüm parsellerin NDVI'sini çek.
-    Tek gün → aggregate_spatial → çok hızlı.
-    """
+def _ndvi_cube(features, start, end):
+    """load_collection → NDVI küpü (t boyutu korunur) + parsel FeatureCollection"""
     conn = get_openeo()
-    geoms = [shape(f["geom"]) for f in features]
-    u = geoms[0]
-    for g in geoms[1:]: u = u.union(g)
-    b = u.bounds
-
-    # Sadece o günü yükle (+1 gün buffer)
-    d_end = (datetime.strptime(actual_date_str, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
-
+    b    = features_bbox(features)
     cube = conn.load_collection(
         "SENTINEL2_L2A",
         spatial_extent={"west":b[0],"south":b[1],"east":b[2],"north":b[3]},
-        temporal_extent=[actual_date_str, d_end],
+        temporal_extent=[start, end],
         bands=["B04","B08"],
         max_cloud_cover=90,
     )
@@ -150,9 +396,6 @@ def fetch_ndvi_for_date(features, actual_date_str):
     b04  = cube.band("B04")
     ndvi = (b08 - b04) / (b08 + b04)
 
-    # Zaman boyutunu kaldır (tek gün var zaten)
-    ndvi = ndvi.reduce_dimension(dimension="t", reducer="mean")
-
     fc = {
         "type": "FeatureCollection",
         "features": [
@@ -160,24 +403,86 @@ def fetch_ndvi_for_date(features, actual_date_str):
             for f in features
         ]
     }
+    return ndvi, fc
+
+def _keep_raw(raw, sink):
+    """Ham yanıtın başı çağıranın listesine (oturum başına; süreç geneli değil)"""
+    if sink is not None: sink.append(str(raw)[:500])
+
+def _next_day(date_str):
+    return (datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+
+@timed("openeo.date", items=lambda features, *a, **k: len(features))
+def fetch_ndvi_for_date(features, actual_date_str, raw=None):
+    """
+    Kesin tarihi bilinen bir gün için tüm parsellerin NDVI'sini çek.
+    Tek gün → aggregate_spatial → çok hızlı.
+    raw: liste verilirse ham yanıtın başı eklenir (debug)
+    """
+    # Sadece o günü yükle (+1 gün buffer)
+    ndvi, fc = _ndvi_cube(features, actual_date_str, _next_day(actual_date_str))
+
+    # Zaman boyutunu kaldır (tek gün var zaten)
+    ndvi = ndvi.reduce_dimension(dimension="t", reducer="mean")
 
     result = ndvi.aggregate_spatial(geometries=fc, reducer="mean")
-    raw    = result.execute()
+    with stage("openeo.execute", len(features)):
+        out = result.execute()
 
-    # Debug: raw yanıtı kaydet
-    st.session_state["_last_raw"] = str(raw)[:500]
+    # Debug: raw yanıtı kaydet (iş parçacığından session_state'e yazılmaz)
+    _keep_raw(out, raw)
 
-    return parse_openeo_response(raw, features)
+    return parse_openeo_response(out, features)
 
-def parse_openeo_response(raw, features):
+@timed("openeo.series", items=lambda features, *a, **k: len(features))
+def fetch_ndvi_timeseries(features, actual_dates, raw=None):
+    """
+    Birden çok kesin tarih için tek process graph / tek execute.
+    Tüm aralık bir kez yüklenir, t boyutu korunur ve sadece istenen
+    günlere indirgenir (aggregate_temporal, gün başına bir aralık).
+    Returns: {actual_date: {fid: ndvi_val}}
+    """
+    dates = sorted(set(actual_dates))
+    ndvi, fc = _ndvi_cube(features, dates[0], _next_day(dates[-1]))
+
+    # Her sahne günü = bir aralık; etiket = gün
+    ndvi = ndvi.aggregate_temporal(
+        intervals=[[d, _next_day(d)] for d in dates], reducer="mean", labels=dates)
+
+    result = ndvi.aggregate_spatial(geometries=fc, reducer="mean")
+    with stage("openeo.execute", len(features)):
+        out = result.execute()
+
+    # Debug: raw yanıtı kaydet (iş parçacığından session_state'e yazılmaz)
+    _keep_raw(out, raw)
+
+    by_date = parse_openeo_response(out, features, by_date=True)
+    if not by_date:
+        raise RuntimeError(f"OpenEO yanıtı çözülemedi: {str(out)[:80]}")
+    empty   = {f["id"]: None for f in features}
+    return {d: by_date.get(d, empty) for d in dates}
+
+def fetch_ndvi_dates(features, actual_dates, series=True, raw=None):
+    """
+    Kesin tarihler için NDVI: birden çok tarih + series → tek execute,
+    aksi halde gün başına fetch_ndvi_for_date.
+    Yakınlık kümelemesi (plan_clusters) çağıranda yapılır; burada tek bbox.
+    Returns: {actual_date: {fid: ndvi_val}}
+    """
+    dates = sorted(set(actual_dates))
+    if series and len(dates) > 1:
+        return fetch_ndvi_timeseries(features, dates, raw)
+    return {d: fetch_ndvi_for_date(features, d, raw) for d in dates}
+
+@timed("openeo.parse", items=lambda raw, features, *a, **k: len(features))
+def parse_openeo_response(raw, features, by_date=False):
     """
     OpenEO aggregate_spatial çıktısı:
     - Liste: [[v1], [v2], ...]  veya [v1, v2, ...]
     - Dict:  {"2024-06-01T..": [[v1],[v2],...]}  (zaman serisi)
     Her parsel için tek sayı çıkar.
+    by_date=True → dict'in tüm zaman dilimleri: {"YYYY-MM-DD": {fid: val}}
     """
-    out = {f["id"]: None for f in features}
-
     def first_num(x):
         if isinstance(x, (int, float)) and x == x and not (isinstance(x,float) and abs(x)>10):
             return float(x)
@@ -187,6 +492,26 @@ def parse_openeo_response(raw, features):
                 if v is not None: return v
         return None
 
+    def per_feature(vals):
+        out = {f["id"]: None for f in features}
+        for i, feat in enumerate(features):
+            v = vals[i] if i < len(vals) else None
+            if v is not None and -1 <= v <= 1:
+                out[feat["id"]] = round(v, 3)
+            # else: None kalır
+        return out
+
+    def slice_vals(ts_val):
+        # Her key altında [[v1,v2,...]] (parsel başına) olabilir
+        # Ya da flat list
+        if isinstance(ts_val, list):
+            return [first_num(item) for item in ts_val]
+        return [first_num(ts_val)]
+
+    if by_date:
+        if not isinstance(raw, dict): return {}
+        return {str(ts)[:10]: per_feature(slice_vals(v)) for ts, v in raw.items()}
+
     vals = []
     if isinstance(raw, list):
         # [[v],[v],...] veya [v,v,...]
@@ -194,81 +519,731 @@ def parse_openeo_response(raw, features):
             vals.append(first_num(item))
     elif isinstance(raw, dict):
         # Zaman serisi dict: keys = timestamps
-        # Her key altında [[v1,v2,...]] (parsel başına) olabilir
-        # Ya da flat list
         for ts_val in raw.values():
-            if isinstance(ts_val, list):
-                for item in ts_val:
-                    vals.append(first_num(item))
-            else:
-                vals.append(first_num(ts_val))
+            vals = slice_vals(ts_val)
             break  # Tek zaman dilimi var
     else:
         v = first_num(raw)
         if v is not None:
             vals = [v] * len(features)
 
-    for i, feat in enumerate(features):
-        v = vals[i] if i < len(vals) else None
-        if v is not None and -1 <= v <= 1:
-            out[feat["id"]] = round(v, 3)
-        # else: None kalır
+    return per_feature(vals)
+
+# ── Yerel raster NDVI motoru (ağsız) ─────────────────────────
+# Diskteki Sentinel-2 B04/B08 GeoTIFF/COG/JP2 dosyaları; dosya yolunda tarih
+# (20240603 / 2024-06-03) ve bant adı olmalı, ör. T36SVK_20240603T083601_B04_10m.jp2
+# BOA ofseti ürün başına: SAFE içindeki MTD_MSIL2A.xml (BOA_ADD_OFFSET), yoksa yoldaki
+# işleme sürümü (_N0400_ ve sonrası → 1000); ikisi de yoksa AGROSENSE_BOA_OFFSET zorunlu.
+LOCAL_RASTER_DIR = os.environ.get("AGROSENSE_RASTER_DIR", "rasters")
+LOCAL_BOA_OFFSET = (float(os.environ["AGROSENSE_BOA_OFFSET"])
+                    if os.environ.get("AGROSENSE_BOA_OFFSET", "").strip() else None)
+LOCAL_PARAMS     = "LOCAL|B04,B08|boa" + ("" if LOCAL_BOA_OFFSET is None
+                                         else f"|off{LOCAL_BOA_OFFSET:g}") + "|mean"
+_BAND_RE = re.compile(r"(\d{4})-?(\d{2})-?(\d{2}).*?(B0?4|B0?8)(?![0-9A-Za-z])", re.I)
+_BASELINE_RE = re.compile(r"_N(\d{2})(\d{2})(?=[_.])")
+
+def _mtd_offsets(path, root):
+    """Dosyanın üst klasörlerindeki MTD_MSIL2A.xml → {band_id: ofset} (yoksa None)"""
+    d = os.path.dirname(os.path.abspath(path)); top = os.path.abspath(root)
+    while True:
+        mtd = os.path.join(d, "MTD_MSIL2A.xml")
+        if os.path.exists(mtd):
+            try:
+                offs = {el.get("band_id"): -float(el.text)
+                        for el in ET.parse(mtd).iter() if el.tag.endswith("BOA_ADD_OFFSET")}
+            except (ET.ParseError, OSError, ValueError, TypeError): return None
+            return offs or {}
+        if d == top or os.path.dirname(d) == d: return None
+        d = os.path.dirname(d)
+
+def _boa_offset(path, band, root):
+    """Ürün başına BOA ofseti (DN'den çıkarılır); bilinmiyorsa None"""
+    offs = _mtd_offsets(path, root)
+    if offs is not None:   # B04 → band_id 3, B08 → 7; liste yoksa 04.00 öncesi (0)
+        return offs.get("3" if band == "B04" else "7", 0.0)
+    m = _BASELINE_RE.search(os.path.relpath(path, root))
+    if m: return 1000.0 if int(m[1]) >= 4 else 0.0
+    return LOCAL_BOA_OFFSET
+
+def _footprint(path):
+    """Karo kapsamı EPSG:4326 [w, s, e, n]; okunamazsa None (elemeye girmez)"""
+    import rasterio
+    from rasterio.warp import transform_bounds
+    try:
+        with rasterio.open(path) as ds:
+            return list(transform_bounds(ds.crs, "EPSG:4326", *ds.bounds)) if ds.crs else None
+    except (rasterio.errors.RasterioError, ValueError):
+        return None
+
+def _bbox_hits(fp, bbox):
+    return fp is None or not (fp[2] < bbox[0] or fp[0] > bbox[2] or fp[3] < bbox[1] or fp[1] > bbox[3])
+
+@st.cache_data(ttl=600, show_spinner=False)
+def local_catalog(root=LOCAL_RASTER_DIR):
+    """
+    Klasörü tara → {tarih: [(b04_yolu, b08_yolu, kapsam, (ofset04, ofset08)), ...]}
+    (karo başına bir kayıt; kapsam EPSG:4326 bbox, ofset bilinmiyorsa None)
+    """
+    pairs = {}
+    for dp, _, fns in os.walk(root):
+        for fn in fns:
+            if not fn.lower().endswith((".tif", ".tiff", ".jp2", ".vrt")): continue
+            rel = os.path.relpath(os.path.join(dp, fn), root)
+            m = _BAND_RE.search(rel)
+            if not m: continue
+            try: date = datetime(int(m[1]), int(m[2]), int(m[3])).strftime("%Y-%m-%d")
+            except ValueError: continue
+            band = "B08" if m[4].endswith("8") else "B04"
+            stem = rel[:m.start(4)] + rel[m.end(4):]
+            pairs.setdefault((date, stem), {})[band] = os.path.join(root, rel)
+    cat = {}
+    for (date, _), p in sorted(pairs.items()):
+        if "B04" in p and "B08" in p:
+            offs = (_boa_offset(p["B04"], "B04", root), _boa_offset(p["B08"], "B08", root))
+            cat.setdefault(date, []).append((p["B04"], p["B08"], _footprint(p["B04"]), offs))
+    return cat
+
+def resolve_local_scenes(bbox, target_dates, days=15):
+    """
+    resolve_scenes karşılığı — sahne listesi yerel katalogdan; yalnızca
+    kapsamı bbox ile kesişen karolar sayılır (başka bölgenin günü seçilmez).
+    """
+    items = []
+    for d, tiles in local_catalog().items():
+        hit = [t for t in tiles if _bbox_hits(t[2], bbox)]
+        if hit: items.append({"properties": {"datetime": d}, "tiles": hit})
+    return {t: pick_nearest(items, t, days) for t in target_dates}
+
+def find_local_scene(bbox, target_date_str, days=15):
+    return resolve_local_scenes(bbox, [target_date_str], days)[target_date_str]
+
+@st.cache_resource(show_spinner=False)
+def parcel_index_cache():
+    """(parsel kümesi özeti, raster ızgarası) → piksel→parsel indeksi"""
+    return SharedCache(max_items=64, ttl=24 * 3600)
+
+def _build_parcel_index(features, ds):
+    """
+    Parselleri bir kez ızgaraya rasterleştir → CSR benzeri sıkıştırılmış indeks:
+    (okuma penceresi, pencere içi düz piksel indeksleri, etiketler 1..n)
+    Parsellerle kesişmeyen ızgarada None.
+    """
+    from rasterio.features import rasterize
+    from rasterio.warp import transform_geom
+    from rasterio.windows import Window, from_bounds
+    from rasterio.errors import WindowError
+
+    geoms = [transform_geom("EPSG:4326", ds.crs, f["geom"]) for f in features]
+    gb    = np.array([shape(g).bounds for g in geoms])
+    try:
+        w = from_bounds(gb[:, 0].min(), gb[:, 1].min(), gb[:, 2].max(), gb[:, 3].max(),
+                        ds.transform)
+        c0, r0 = math.floor(w.col_off), math.floor(w.row_off)
+        win = Window(c0, r0, math.ceil(w.col_off + w.width) - c0 + 1,
+                     math.ceil(w.row_off + w.height) - r0 + 1
+                     ).intersection(Window(0, 0, ds.width, ds.height))
+    except WindowError:
+        return None   # karo parsellerle kesişmiyor
+    lab = rasterize(((g, i + 1) for i, g in enumerate(geoms)),
+                    out_shape=(int(win.height), int(win.width)),
+                    transform=ds.window_transform(win), fill=0, dtype="int32").ravel()
+    pix = np.flatnonzero(lab)
+    if not len(pix): return None
+    return win, pix, lab[pix]
+
+def parcel_index(features, ds):
+    """
+    _build_parcel_index — parsel kümesi (geometri özetleri, sırayla) + ızgara
+    başına bir kez kurulur; geometri değişince özet de değişir (otomatik geçersiz).
+    """
+    pset = hashlib.sha1("|".join(feature_hash(f) for f in features).encode()).hexdigest()
+    grid = (str(ds.crs), tuple(ds.transform)[:6], ds.width, ds.height)
+    return parcel_index_cache().compute((pset, grid), lambda: _build_parcel_index(features, ds))
+
+ZONAL_REDUCERS = ["mean", "median", "min", "max", "std"]
+
+def _zonal_reduce(lab, vals, n, reducer="mean"):
+    """
+    Etiketli piksel değerlerinden parsel başına istatistik (vektörel, döngüsüz).
+    lab: 1..n etiketler, vals: NDVI (NaN = geçersiz). Returns: dizi[n+1] (0 = boş)
+    """
+    ok = ~np.isnan(vals); lab = lab[ok]; vals = vals[ok]
+    cnt = np.bincount(lab, minlength=n + 1).astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if reducer in ("mean", "std"):
+            mean = np.bincount(lab, weights=vals, minlength=n + 1) / cnt
+            if reducer == "mean": return mean
+            sq = np.bincount(lab, weights=vals * vals, minlength=n + 1) / cnt
+            return np.sqrt(np.maximum(sq - mean * mean, 0))
+        order = np.lexsort((vals, lab)); v = vals[order]
+        c = cnt.astype(int); start = np.cumsum(c) - c; has = c > 0
+        out = np.full(n + 1, np.nan)
+        if reducer == "min":
+            out[has] = v[start[has]]
+        elif reducer == "max":
+            out[has] = v[start[has] + c[has] - 1]
+        elif reducer == "median":
+            out[has] = (v[start[has] + (c[has] - 1) // 2] + v[start[has] + c[has] // 2]) / 2
+        else:
+            raise ValueError(f"Bilinmeyen indirgeyici: {reducer}")
+        return out
+
+def _fid_vals(features, arr):
+    """dizi[n+1] → {fid: ndvi} (geçersiz/aralık dışı → None)"""
+    out = {}
+    for i, f in enumerate(features, 1):
+        v = float(arr[i])
+        out[f["id"]] = round(v, 3) if v == v and -1 <= v <= 1 else None
+    return out
+
+def _zonal_local(features, tiles, reducer="mean"):
+    """
+    Karolardan pencere okuma → NumPy NDVI → önceden kurulmuş parsel indeksi
+    üzerinde tek bincount geçişi (parsel başına ortalama / reducer).
+    Returns: {fid: ndvi}
+    """
+    import rasterio
+
+    labs = []; vals = []
+    for b04p, b08p, _, (off4, off8) in tiles:
+        with rasterio.open(b04p) as r4, rasterio.open(b08p) as r8:
+            idx = parcel_index(features, r4)
+            if idx is None: continue
+            win, pix, lab = idx
+            shp = (int(win.height), int(win.width))
+            red = r4.read(1, window=win, out_dtype="float32").ravel()[pix]
+            nir = r8.read(1, window=win, out_shape=shp, out_dtype="float32").ravel()[pix]
+        if off4 is None or off8 is None:
+            raise RuntimeError(f"BOA ofseti bilinmiyor ({os.path.basename(b04p)}); "
+                               "AGROSENSE_BOA_OFFSET ayarlayın")
+        ok   = (red > 0) & (nir > 0)   # 0 = nodata
+        red -= off4; nir -= off8
+        den  = nir + red
+        ok  &= den != 0
+        labs.append(lab[ok]); vals.append((nir[ok] - red[ok]) / den[ok])
+
+    if not labs: return {f["id"]: None for f in features}
+    return _fid_vals(features, _zonal_reduce(np.concatenate(labs), np.concatenate(vals),
+                                             len(features), reducer))
+
+@timed("local.fetch", items=lambda features, *a, **k: len(features))
+def fetch_ndvi_local(features, actual_dates, series=True, reducer="mean"):
+    """
+    fetch_ndvi_shared karşılığı — yerel raster motoru (ağ yok).
+    Returns: {actual_date: {fid: ndvi_val}}
+    """
+    cat = local_catalog()
+    return {d: _zonal_local(features, cat.get(d, []), reducer) for d in sorted(set(actual_dates))}
+
+# ── Küp modu: NDVI küpü bir kez indirilir, sonra her şey yerelde ─
+# OpenEO → netCDF (t boyutu = sahne günleri) → döşemeli (256×256) float32 GeoTIFF,
+# bant açıklaması = tarih. Yeni seçim / alt alan / indirgeyici diskteki küpten okunur.
+CUBE_DIR   = os.environ.get("AGROSENSE_CUBE_DIR",
+                 os.path.join(os.path.expanduser("~"), ".agrosense", "cubes"))
+CUBE_PARAMS = "CUBE|SENTINEL2_L2A|B04,B08|cc90"
+_cube_lock  = threading.Lock()
+
+def _cube_index():
+    try:
+        with open(os.path.join(CUBE_DIR, "index.json"), encoding="utf-8") as fh: return json.load(fh)
+    except (OSError, ValueError): return {}
+
+@contextmanager
+def _cube_index_lock():
+    """index.json oku-değiştir-yaz kilidi: iş parçacıkları + süreçler (batch.py) arası"""
+    try: import fcntl
+    except ImportError: fcntl = None   # Windows: yalnızca süreç içi kilit
+    with _cube_lock, open(os.path.join(CUBE_DIR, "index.lock"), "a") as fh:
+        if fcntl: fcntl.flock(fh, fcntl.LOCK_EX)   # dosya kapanınca bırakılır
+        yield
+
+def _cube_index_add(name, meta):
+    """Küp kaydını ekle — geçici dosya + os.replace (okuyan yarım JSON görmez)"""
+    path = os.path.join(CUBE_DIR, "index.json")
+    with _cube_index_lock():
+        idx = _cube_index(); idx[name] = meta
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh: json.dump(idx, fh)
+        os.replace(tmp, path)
+
+def find_cube(features, dates):
+    """Parsellerin bbox'unu ve tüm tarihleri kapsayan yerel küp yolu (yoksa None)"""
+    b = features_bbox(features)
+    for fn, meta in _cube_index().items():
+        cb = meta["bbox"]; path = os.path.join(CUBE_DIR, fn)
+        if (cb[0] <= b[0] and cb[1] <= b[1] and cb[2] >= b[2] and cb[3] >= b[3]
+                and set(dates) <= set(meta["dates"]) and os.path.exists(path)):
+            return path
+    return None
+
+def _nc_dates(src, fallback):
+    """netCDF bant etiketlerinden (NETCDF_DIM_t + t#units) tarih listesi"""
+    m = re.match(r"(\w+) since (\d{4}-\d{2}-\d{2})", src.tags().get("t#units", ""))
+    tv = [src.tags(i).get("NETCDF_DIM_t") for i in src.indexes]
+    if m and None not in tv:
+        step = {"days": 1, "hours": 1 / 24, "minutes": 1 / 1440, "seconds": 1 / 86400}.get(m[1], 1)
+        base = datetime.strptime(m[2], "%Y-%m-%d")
+        return [(base + timedelta(days=float(t) * step)).strftime("%Y-%m-%d") for t in tv]
+    if len(fallback) == src.count: return list(fallback)
+    raise RuntimeError(f"Küp tarihleri okunamadı ({src.count} bant)")
+
+def _nc_to_tiled_tif(nc_path, tif_path, dates):
+    """netCDF küpü → döşemeli, sıkıştırılmış çok bantlı GeoTIFF (bant = tarih)"""
+    import rasterio
+    with rasterio.open(nc_path) as root:
+        sds = root.subdatasets
+    src_path = next((x for x in sds if x.endswith(":NDVI")), sds[0] if sds else nc_path)
+    with rasterio.open(src_path) as src:
+        labels = _nc_dates(src, dates)
+        prof = dict(driver="GTiff", width=src.width, height=src.height, count=src.count,
+                    dtype="float32", crs=src.crs, transform=src.transform, nodata=float("nan"),
+                    tiled=True, blockxsize=256, blockysize=256, compress="deflate",
+                    interleave="band")
+        with rasterio.open(tif_path, "w", **prof) as dst:
+            for i, d in enumerate(labels, 1):
+                arr = src.read(i, out_dtype="float32")
+                if src.nodata is not None and src.nodata == src.nodata:
+                    arr[arr == src.nodata] = np.nan
+                dst.write(arr, i); dst.set_band_description(i, d)
+    return labels
+
+@timed("cube.download", items=lambda features, *a, **k: len(features))
+def download_ndvi_cube(features, dates):
+    """
+    Seçimin bbox'u + sahne günleri için NDVI küpünü tek execute ile indir ve sakla.
+    Returns: yerel GeoTIFF yolu
+    """
+    dates = sorted(set(dates)); b = features_bbox(features)
+    key   = hashlib.sha1(json.dumps([[round(x, 6) for x in b], dates]).encode()).hexdigest()[:16]
+    path  = os.path.join(CUBE_DIR, f"{key}.tif")
+    os.makedirs(CUBE_DIR, exist_ok=True)
+
+    ndvi, _ = _ndvi_cube(features, dates[0], _next_day(dates[-1]))
+    ndvi = ndvi.aggregate_temporal(
+        intervals=[[d, _next_day(d)] for d in dates], reducer="mean", labels=dates)
+    ndvi = ndvi.add_dimension(name="bands", label="NDVI", type="bands")
+    with tempfile.TemporaryDirectory() as td:
+        nc = os.path.join(td, "ndvi.nc")
+        ndvi.download(nc, format="netCDF")
+        tmp = f"{path}.{os.getpid()}.tmp"   # aynı küpü okuyan başka süreç varken üzerine yazma
+        try:
+            labels = _nc_to_tiled_tif(nc, tmp, dates)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+
+    _cube_index_add(os.path.basename(path), {"bbox": b, "dates": labels})
+    return path
 
+@timed("cube.stats", items=lambda features, *a, **k: len(features))
+def cube_stats(features, path, dates, reducer="mean"):
+    """
+    Yerel küpten parsel istatistikleri — parsel indeksi + bant başına tek okuma.
+    Returns: {date: {fid: ndvi}}
+    """
+    import rasterio
+    with rasterio.open(path) as ds:
+        bands = {d: i for i, d in enumerate(ds.descriptions, 1) if d}
+        idx   = parcel_index(features, ds)
+        out   = {}
+        for d in sorted(set(dates)):
+            if idx is None or d not in bands:
+                out[d] = {f["id"]: None for f in features}; continue
+            win, pix, lab = idx
+            vals = ds.read(bands[d], window=win, out_dtype="float32").ravel()[pix]
+            out[d] = _fid_vals(features, _zonal_reduce(lab, vals, len(features), reducer))
     return out
 
+def fetch_ndvi_cube(features, actual_dates, series=True, reducer="mean"):
+    """
+    Küp modu: kapsayan yerel küp varsa ondan hesapla, yoksa bir kez indir.
+    Eşzamanlı aynı indirmeler tekilleştirilir.
+    Returns: {actual_date: {fid: ndvi_val}}
+    """
+    dates = sorted(set(actual_dates))
+    path  = find_cube(features, dates)
+    if path is None:
+        key  = ("cube", tuple(sorted(feature_hash(f) for f in features)), tuple(dates))
+        path = ndvi_mem_cache().compute(key, lambda: download_ndvi_cube(features, dates),
+                                        store=False)
+    return cube_stats(features, path, dates, reducer)
+
 # ── Ana NDVI fonksiyonu: STAC + OpenEO ───────────────────────
-def fetch_ndvi_batch(features, target_date_str):
+def features_bbox(features):
+    """Parsellerin toplam bbox'u: [west, south, east, north] (ParcelStore dict'lerinde hazır "_b")"""
+    bs = np.array([f["_b"] if "_b" in f else shape(f["geom"]).bounds for f in features], dtype=float)
+    return [float(bs[:, 0].min()), float(bs[:, 1].min()),
+            float(bs[:, 2].max()), float(bs[:, 3].max())]
+
+# İstek planlama: uzak parsel grupları ayrı dar bbox'larla istenir.
+# Bir isteğin maliyeti = sabit ek yük + bbox alanı (km²); toplam maliyeti en düşük k seçilir.
+CLUSTER_OVERHEAD_KM2 = 25.0   # ~1 istek ek yükü ≈ 25 km² piksel (10 m → 250k piksel)
+CLUSTER_MIN_FILL     = 0.25   # parsel alanı / bbox alanı bu orandan büyükse bölme
+CLUSTER_MAX_K        = 8
+
+def _bbox_km2(b):
+    lat = math.radians((b[1] + b[3]) / 2)
+    return (b[2] - b[0]) * 111.32 * math.cos(lat) * (b[3] - b[1]) * 110.57
+
+def _kmeans(pts, k, iters=20):
+    """Deterministik k-means (en uzak nokta başlatma) — etiket dizisi döner."""
+    cen = [pts[0]]
+    for _ in range(1, k):
+        d = np.min([((pts - c) ** 2).sum(1) for c in cen], axis=0)
+        cen.append(pts[int(d.argmax())])
+    cen = np.array(cen)
+    for _ in range(iters):
+        lab = ((pts[:, None, :] - cen[None]) ** 2).sum(2).argmin(1)
+        new = np.array([pts[lab == j].mean(0) if (lab == j).any() else cen[j] for j in range(k)])
+        if np.allclose(new, cen): break
+        cen = new
+    return lab
+
+def plan_clusters(store, idx, max_k=CLUSTER_MAX_K):
+    """
+    Seçili parselleri (store konumları) merkez noktalarına göre kümeler (k-means, k=1..max_k).
+    Her küme bir alt istek: maliyet = Σ(ek yük + küme bbox alanı).
+    Geometriye dokunmaz: store.bounds / cxy / areas dizileri kullanılır.
+    Returns: [konum dizisi, ...]
+    """
+    idx = np.asarray(idx)
+    if len(idx) < 2: return [idx]
+    bnds  = store.bounds[idx]
+    full  = [bnds[:, 0].min(), bnds[:, 1].min(), bnds[:, 2].max(), bnds[:, 3].max()]
+    lat   = math.cos(math.radians((full[1] + full[3]) / 2))
+    farm  = store.areas[idx].sum() / 1000   # dekar → km²
+    if farm >= CLUSTER_MIN_FILL * _bbox_km2(full):
+        return [idx]
+
+    def cost(lab):
+        c = 0.0
+        for j in set(lab.tolist()):
+            bb = bnds[lab == j]
+            c += CLUSTER_OVERHEAD_KM2 + _bbox_km2(
+                [bb[:, 0].min(), bb[:, 1].min(), bb[:, 2].max(), bb[:, 3].max()])
+        return c
+
+    pts  = store.cxy[idx] * [lat, 1.0]
+    best = np.zeros(len(idx), dtype=int); best_c = cost(best)
+    for k in range(2, min(max_k, len(idx)) + 1):
+        lab = _kmeans(pts, k); c = cost(lab)
+        if c < best_c: best, best_c = lab, c
+    return [idx[best == j] for j in sorted(set(best.tolist()))]
+
+def group_jobs(to_do, scenes, series=True):
     """
-    1. STAC ile ±15 gün içinde en yakın tarihi bul (hızlı)
-    2. O gün için tüm parselleri tek batch ile çek
-    Returns: {fid: ndvi_val}, actual_date_str
+    (tarih, eksik parsel konumları) listesini aynı parsel kümesine ve çözülmüş sahneye göre grupla.
+    Aynı güne düşen hedef tarihler tek execute ile hesaplanır; series=True ise
+    aynı parsel kümesinin tüm sahne günleri tek işte (fetch_ndvi_timeseries) birleşir.
+    Returns: [(konumlar, {actual_date: [target_dates]})], [(target_date, konumlar)] (sahne yok)
     """
-    # Tüm parsellerin bbox'u
-    geoms = [shape(f["geom"]) for f in features]
-    u = geoms[0]
-    for g in geoms[1:]: u = u.union(g)
-    b = u.bounds
-    bbox = [b[0], b[1], b[2], b[3]]
+    jobs = {}; out = []; empty = []
+    for date, missing in to_do:
+        actual = (scenes.get(date) or (None, None))[0]
+        if actual is None:
+            empty.append((date, missing)); continue
+        ids = np.sort(np.asarray(missing, dtype=np.int64)).tobytes()
+        key = ids if series else (ids, actual)
+        if key not in jobs:
+            jobs[key] = (missing, {}); out.append(jobs[key])
+        jobs[key][1].setdefault(actual, []).append(date)
+    return out, empty
+
+# ── Kalıcı NDVI önbelleği (SQLite) ───────────────────────────
+# Anahtar: geometri özeti + gerçek sahne tarihi + işleme parametreleri.
+# Yeniden yükleme / yeni oturum / sunucu yeniden başlatma sonrası da geçerli.
+NDVI_CACHE_PATH   = os.environ.get("AGROSENSE_CACHE",
+                        os.path.join(os.path.expanduser("~"), ".agrosense", "ndvi_cache.sqlite"))
+NDVI_CACHE_MAX    = 1_000_000   # en çok satır; aşılınca en eski kullanılanlar silinir
+NDVI_PARAMS       = "SENTINEL2_L2A|B04,B08|cc90|mean"   # graf değişirse anahtarı değiştir
+
+def _snap(g):
+    """1e-7° ızgaraya oturt; geçersiz (kendini kesen) halkalar topoloji kurmadan yuvarlanır"""
+    ok = shapely.is_valid(g)
+    if np.all(ok): return shapely.set_precision(g, 1e-7)
+    out = shapely.set_precision(g, 1e-7, mode="pointwise")
+    if np.ndim(g): out[ok] = shapely.set_precision(g[ok], 1e-7)
+    return out
 
-    actual_date, scene = find_nearest_scene(bbox, target_date_str, days=15)
-    if actual_date is None:
-        return {f["id"]: None for f in features}, None
+def geom_hash(geom):
+    """Kanonik geometri özeti: 1e-7° hassasiyet + normalize → WKB → sha1"""
+    g = shapely.normalize(_snap(shape(geom)))
+    return hashlib.sha1(shapely.to_wkb(g, hex=False)).hexdigest()[:24]
+
+def geom_hashes(geoms):
+    """geom_hash'in vektörel hâli — shapely geometri dizisi için"""
+    g = shapely.normalize(_snap(np.asarray(geoms, dtype=object)))
+    return [hashlib.sha1(w).hexdigest()[:24] for w in shapely.to_wkb(g, hex=False)]
+
+def feature_hash(f):
+    """Parsel başına geometri özeti (feature dict'inde saklanır)"""
+    if "_h" not in f: f["_h"] = geom_hash(f["geom"])
+    return f["_h"]
+
+class NdviCache:
+    """İş parçacığı güvenli, boyut sınırlı SQLite NDVI önbelleği."""
+    def __init__(self, path=NDVI_CACHE_PATH, max_rows=NDVI_CACHE_MAX):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.hits = 0; self.misses = 0
+        # batch.py süreçleri aynı dosyaya yazar — kilit beklemesi uzun tutulur
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS ndvi(
+            ghash TEXT, date TEXT, params TEXT, ndvi REAL, used REAL,
+            PRIMARY KEY(ghash, date, params))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS ndvi_used ON ndvi(used)")
+        self.db.commit()
+
+    def get(self, hashes, date, params=NDVI_PARAMS):
+        """Returns: {ghash: ndvi} — sadece önbellekte olanlar (ndvi None olabilir)"""
+        hashes = list(set(hashes)); out = {}
+        with self.lock:
+            for i in range(0, len(hashes), 500):
+                part = hashes[i:i+500]
+                q = ",".join("?" * len(part))
+                out.update(self.db.execute(
+                    f"SELECT ghash, ndvi FROM ndvi WHERE date=? AND params=? AND ghash IN ({q})",
+                    [date, params, *part]).fetchall())
+            self.hits += len(out); self.misses += len(hashes) - len(out)
+            if out:
+                self.db.executemany("UPDATE ndvi SET used=? WHERE ghash=? AND date=? AND params=?",
+                                    [(time.time(), h, date, params) for h in out])
+                self.db.commit()
+        return out
+
+    def put(self, values, date, params=NDVI_PARAMS):
+        """values: {ghash: ndvi}"""
+        now = time.time()
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO ndvi VALUES(?,?,?,?,?)",
+                                [(h, date, params, v, now) for h, v in values.items()])
+            n = self.db.execute("SELECT COUNT(*) FROM ndvi").fetchone()[0]
+            if n > self.max_rows:
+                # %10 pay bırakarak en eski kullanılanları sil
+                self.db.execute("DELETE FROM ndvi WHERE rowid IN "
+                                "(SELECT rowid FROM ndvi ORDER BY used LIMIT ?)",
+                                (n - int(self.max_rows * 0.9),))
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM ndvi"); self.db.commit()
 
-    ndvi_vals = fetch_ndvi_for_date(features, actual_date)
-    return ndvi_vals, actual_date
+@st.cache_resource(show_spinner=False)
+def get_ndvi_cache():
+    """Süreç başına tek bağlantı; disk yazılamazsa None (önbelleksiz çalış)"""
+    try: return NdviCache()
+    except (sqlite3.Error, OSError): return None
+
+@timed("cache.lookup", items=lambda features, *a, **k: len(features))
+def cache_lookup(store, idx, actual_date, params=NDVI_PARAMS):
+    """
+    Önbellekteki parseller (store konumları) → ({fid: ndvi}, kalan konumlar)
+    Önce süreç belleği (ndvi_mem_cache), sonra SQLite. Geometri özetleri store'da hazır.
+    """
+    mem  = ndvi_mem_cache()
+    hs   = [store.hashes[i] for i in idx]
+    keys = {h: (h, actual_date, params) for h in hs}
+    got  = mem.get_many(list(keys.values()))
+    hit  = {h: got[k] for h, k in keys.items() if k in got}
+    cache = get_ndvi_cache()
+    rest  = [h for h in keys if h not in hit]
+    if cache and rest:
+        try: disk = cache.get(rest, actual_date, params)
+        except sqlite3.Error: disk = {}
+        mem.put_many({keys[h]: v for h, v in disk.items()})
+        hit.update(disk)
+    found = np.fromiter((h in hit for h in hs), dtype=bool, count=len(hs))
+    vals  = {store.ids[i]: hit[h] for i, h, ok in zip(idx, hs, found) if ok}
+    return vals, np.asarray(idx)[~found]
+
+def cache_store(store, idx, by_act, params=NDVI_PARAMS):
+    """
+    by_act: {actual_date: {fid: ndvi}} (idx parselleri) → bellek + disk önbelleğine yaz.
+    None yazılmaz: eksik tarih / çözülemeyen yanıt ile gerçek boş değer
+    ayırt edilemez; o parseller bir sonraki istekte yeniden sorulur.
+    """
+    cache = get_ndvi_cache()
+    for actual, vals in by_act.items():
+        hv = {store.hashes[i]: vals[store.ids[i]] for i in idx if vals.get(store.ids[i]) is not None}
+        if not hv: continue
+        ndvi_mem_cache().put_many({(h, actual, params): v for h, v in hv.items()})
+        if not cache: continue
+        try: cache.put(hv, actual, params)
+        except sqlite3.Error: pass
+
+def fetch_ndvi_shared(features, actual_dates, series=True, raw=None):
+    """
+    fetch_ndvi_dates (kümelemesiz) — aynı parsel geometrileri + tarihler için
+    eşzamanlı istekler (farklı oturumlar dahil) tek arka uç çağrısına iner.
+    raw: liste verilirse bu işin ham yanıt özetleri eklenir
+    """
+    hashes = {f["id"]: feature_hash(f) for f in features}
+    key = ("job", tuple(sorted(hashes.values())), tuple(sorted(set(actual_dates))), series)
+    def run():
+        snips = []
+        by_act = fetch_ndvi_dates(features, actual_dates, series, snips)
+        return {d: {hashes[fid]: v for fid, v in vals.items()} for d, vals in by_act.items()}, snips
+    by_hash, snips = ndvi_mem_cache().compute(key, run, store=False)
+    if raw is not None: raw.extend(snips)
+    return {d: {fid: vals.get(h) for fid, h in hashes.items()} for d, vals in by_hash.items()}
+
+# ── NDVI hesap motorları ─────────────────────────────────────
+# resolve: tüm tarihler için sahne; nearest: tek tarih (yedek); fetch: {tarih: {fid: ndvi}}
+# reducers: desteklenen parsel istatistikleri (mean dışı → fetch(..., reducer=...))
+NDVI_BACKENDS = {
+    "openeo": {"label": "🛰 OpenEO (uzak)", "params": NDVI_PARAMS, "cluster": True,
+               "resolve": resolve_scenes, "nearest": find_nearest_scene,
+               "fetch": fetch_ndvi_shared, "reducers": ["mean"]},
+    "local":  {"label": "💽 Yerel raster", "params": LOCAL_PARAMS, "cluster": False,
+               "resolve": resolve_local_scenes, "nearest": find_local_scene,
+               "fetch": fetch_ndvi_local, "reducers": ZONAL_REDUCERS},
+    "cube":   {"label": "🧊 Küp (yerel kopya)", "params": CUBE_PARAMS, "cluster": False,
+               "resolve": resolve_scenes, "nearest": find_nearest_scene,
+               "fetch": fetch_ndvi_cube, "reducers": ZONAL_REDUCERS},
+}
+
+# ── Eşzamanlı iş yürütücü ────────────────────────────────────
+STAC_WORKERS   = 4   # aynı anda en çok STAC isteği
+OPENEO_WORKERS = 3   # aynı anda en çok OpenEO execute
+
+def run_analysis(store, to_do, series=True, workers=OPENEO_WORKERS, backend="openeo",
+                 reducer="mean", raw=None):
+    """
+    Analiz döngüsü — STAC çözümleme ve OpenEO execute'ları iş parçacığı
+    havuzlarında örtüşerek çalışır (arka uç başına sınırlı paralellik).
+    to_do: [(target_date, store konumları)] — bbox, kümeleme ve önbellek
+    store dizileriyle yapılır; feature dict'leri yalnızca önbellekte olmayan
+    parseller için, arka uca giderken kurulur.
+    Biten her parça hemen üretilir (generator):
+        (target_date, {fid: ndvi_val}, actual_date, hata_mesajı|None)
+    Streamlit'e dokunmaz; session_state güncellemesi çağırana aittir.
+    backend: NDVI_BACKENDS anahtarı ("openeo" / "local" / "cube")
+    reducer: parsel istatistiği (motorun "reducers" listesinden)
+    raw: liste verilirse OpenEO ham yanıt özetleri (iş başına) eklenir
+    """
+    if not to_do: return
+    blank  = lambda idx: {store.ids[i]: None for i in idx}
+    be     = NDVI_BACKENDS[backend]
+    fetch  = be["fetch"] if reducer == "mean" else partial(be["fetch"], reducer=reducer)
+    if raw is not None and be["fetch"] is fetch_ndvi_shared: fetch = partial(fetch, raw=raw)
+    params = be["params"] if reducer == "mean" else f"{be['params']}|{reducer}"
+    # önbellekleri ana iş parçacığında ısıt; kimlik/bağlantı hatası tarih bazlı hata olur
+    if be["resolve"] is resolve_scenes:
+        try: get_token(); get_openeo()
+        except Exception as e:
+            for date, missing in to_do:
+                yield date, blank(missing), date, str(e)[:120]
+            return
+        scene_cache()
+    if backend != "openeo": parcel_index_cache()
+    ndvi_mem_cache(); get_ndvi_cache(); store.tier(BACKEND_TOL_M)
+    every = np.unique(np.concatenate([np.asarray(m, dtype=int) for _, m in to_do]))
+
+    def job(idx, dates):
+        return fetch(store.features_at(idx, props=False), dates, series)
+
+    with ThreadPoolExecutor(STAC_WORKERS) as stac, ThreadPoolExecutor(max(1, workers)) as oeo:
+        pending = {}
+
+        def submit_jobs(items, scenes):
+            # Kalıcı önbellekte olan parsel·sahne çiftleri uzak işe girmez
+            rest = []
+            for date, missing in items:
+                actual = (scenes.get(date) or (None, None))[0]
+                if actual is not None:
+                    hit, missing = cache_lookup(store, missing, actual, params)
+                    if hit: yield date, hit, actual, None
+                if len(missing): rest.append((date, missing))
+            jobs, empty = group_jobs(rest, scenes, series)
+            for date, missing in empty:
+                yield date, blank(missing), date, "±15 gün içinde görüntü yok"
+            for missing, plan in jobs:
+                for grp in (plan_clusters(store, missing) if be["cluster"] else [missing]):
+                    fut = oeo.submit(job, grp, list(plan))
+                    pending[fut] = ("ndvi", grp, plan)
+
+        # Tüm tarihler için tek STAC taraması; hata (ör. sayfa sınırı) olursa tarih bazlı sorguya düş
+        try: scenes = be["resolve"](store.total_bounds(every), [d for d, _ in to_do])
+        except Exception: scenes = {}
+        for date, missing in to_do:
+            if date not in scenes:
+                fut = stac.submit(be["nearest"], store.total_bounds(missing), date, 15)
+                pending[fut] = ("stac", missing, date)
+        yield from submit_jobs([(d, m) for d, m in to_do if d in scenes], scenes)
+
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for fut in done:
+                kind, missing, info = pending.pop(fut)
+                if kind == "stac":
+                    try: res = fut.result()
+                    except Exception as e:
+                        yield info, blank(missing), info, str(e)[:120]
+                        continue
+                    yield from submit_jobs([(info, missing)], {info: res})
+                    continue
+                try: by_act = fut.result()
+                except Exception as e:
+                    for ds in info.values():
+                        for date in ds:
+                            yield date, blank(missing), date, str(e)[:120]
+                    continue
+                cache_store(store, missing, by_act, params)
+                for actual, ds in info.items():
+                    for date in ds:
+                        yield date, by_act[actual], actual, None
 
 # ── Yardımcılar ───────────────────────────────────────────────
+# (üst sınır, renk) — harita JS stilinde de aynı tablo kullanılır
+NDVI_BREAKS = [(0, "#5ab4d6"), (0.10, "#d73027"), (0.20, "#f46d43"), (0.25, "#fdae61"),
+               (0.35, "#fee08b"), (0.45, "#d9ef8b"), (0.55, "#a6d96a"), (0.65, "#66bd63")]
+NDVI_TOP = "#1a9850"
+
 def ndvi_color(v):
     if v is None: return "#888"
-    if v<0:      return "#5ab4d6"
-    if v<0.10:   return "#d73027"
-    if v<0.20:   return "#f46d43"
-    if v<0.25:   return "#fdae61"
-    if v<0.35:   return "#fee08b"
-    if v<0.45:   return "#d9ef8b"
-    if v<0.55:   return "#a6d96a"
-    if v<0.65:   return "#66bd63"
-    return "#1a9850"
-
-def ndvi_status(v):
-    if v is None: return "Veri yok"
-    if v>0.35:   return "🌾 Ekili"
-    if v>0.15:   return "🟡 Geçiş"
-    return "🌱 Boş/Nadas"
-
-def area_dk(g):
-    try:
-        s = shape(g)
-        if s.geom_type == "MultiPolygon": s = max(s.geoms, key=lambda x: x.area)
-        c = list(s.exterior.coords)
-        lat0 = sum(x[1] for x in c) / len(c)
-        R=6371000; lm=R*math.pi/180; lo=R*math.cos(math.radians(lat0))*math.pi/180
-        a=0; n=len(c)
-        for i in range(n):
-            x1,y1=c[i][0]*lo,c[i][1]*lm; x2,y2=c[(i+1)%n][0]*lo,c[(i+1)%n][1]*lm
-            a+=x1*y2-x2*y1
-        return round(abs(a)/2/1000,2)
-    except: return 0
+    for lim, c in NDVI_BREAKS:
+        if v < lim: return c
+    return NDVI_TOP
+
+# WGS84 — eşit alanlı (Lambert azimutal, otalik enlem) izdüşüm için
+_WGS84_A  = 6378137.0
+_WGS84_E2 = 6.69437999014e-3
+_WGS84_E  = math.sqrt(_WGS84_E2)
+
+def _authalic_q(sinphi):
+    es = _WGS84_E * sinphi
+    return (1 - _WGS84_E2) * (sinphi / (1 - es * es)
+                              - np.log((1 - es) / (1 + es)) / (2 * _WGS84_E))
+
+_QP = float(_authalic_q(np.float64(1.0)))
+_RQ = _WGS84_A * math.sqrt(_QP / 2)
+
+def areas_dk(geoms):
+    """
+    Tüm parsellerin alanı (dekar) tek seferde: koordinatlar elipsoid üzerinde
+    eşit alanlı Lambert azimutal izdüşüme (katman merkezli) vektörel taşınır,
+    shapely.area delikleri ve tüm MultiPolygon parçalarını hesaba katar.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    if not len(geoms): return np.zeros(0)
+    b    = shapely.bounds(geoms)
+    lon0 = np.radians(np.nanmean((b[:, 0] + b[:, 2]) / 2))
+    lat0 = np.radians(np.nanmean((b[:, 1] + b[:, 3]) / 2))
+    sb0  = _authalic_q(np.sin(lat0)) / _QP; cb0 = math.sqrt(max(1 - sb0 * sb0, 0))
+
+    def laea(xy):
+        lam = np.radians(xy[:, 0]) - lon0
+        sb  = np.clip(_authalic_q(np.sin(np.radians(xy[:, 1]))) / _QP, -1, 1)
+        cb  = np.sqrt(1 - sb * sb)
+        k   = np.sqrt(2 / (1 + sb0 * sb + cb0 * cb * np.cos(lam)))
+        return np.column_stack((_RQ * k * cb * np.sin(lam),
+                                _RQ * k * (cb0 * sb - sb0 * cb * np.cos(lam))))
+
+    a = shapely.area(shapely.transform(geoms, laea))
+    return np.round(np.nan_to_num(a) / 1000, 2)
 
 # ── Dosya okuma ───────────────────────────────────────────────
 def parse_geojson(d):
@@ -277,61 +1252,692 @@ def parse_geojson(d):
             for i,f in enumerate(fc.get("features",[]))
             if f.get("geometry") and "Polygon" in f["geometry"].get("type","")]
 
+def _kml_ring(text):
+    """KML koordinat metni → kapalı halka [[lon,lat],...] (toplu numpy ayrıştırma)"""
+    toks = text.split()
+    if not toks: return None
+    dims = toks[0].count(",") + 1
+    try:
+        arr = np.array(text.replace(",", " ").split(), dtype=float)
+        if dims < 2 or arr.size != len(toks) * dims: raise ValueError
+        xy = arr.reshape(-1, dims)[:, :2]
+    except ValueError:
+        # düzensiz/bozuk demetler: tek tek ayrıştır, bozukları atla
+        pts = []
+        for tok in toks:
+            p = tok.split(",")
+            if len(p) >= 2:
+                try: pts.append((float(p[0]), float(p[1])))
+                except ValueError: pass
+        xy = np.array(pts, dtype=float).reshape(-1, 2)
+    if len(xy) < 3: return None
+    if (xy[0] != xy[-1]).any(): xy = np.vstack([xy, xy[:1]])
+    return xy.tolist()
+
+def _local(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def _kml_placemark(pm):
+    """Placemark → (props, geojson geometri | None) — Polygon, MultiGeometry, iç halkalar"""
+    props = {"name": ""}; polys = []
+    for c in pm:
+        if _local(c.tag) == "name": props["name"] = c.text or ""
+    for el in pm.iter():
+        t = _local(el.tag)
+        if t == "Data":
+            k = el.get("name", "")
+            ve = next((c for c in el if _local(c.tag) == "value"), None)
+            if k and ve is not None: props[k] = ve.text or ""
+        elif t == "SimpleData":
+            k = el.get("name", "")
+            if k: props[k] = el.text or ""
+        elif t == "Polygon":
+            outer = None; holes = []
+            for bnd in el:
+                bt = _local(bnd.tag)
+                if bt not in ("outerBoundaryIs", "innerBoundaryIs"): continue
+                ce = next((c for c in bnd.iter() if _local(c.tag) == "coordinates"), None)
+                ring = _kml_ring(ce.text) if ce is not None and ce.text else None
+                if ring is None: continue
+                if bt == "outerBoundaryIs": outer = ring
+                else: holes.append(ring)
+            if outer: polys.append([outer] + holes)
+    if not polys: return props, None
+    if len(polys) == 1: return props, {"type": "Polygon", "coordinates": polys[0]}
+    return props, {"type": "MultiPolygon", "coordinates": polys}
+
+_XML_ENC_RE = re.compile(rb"""^\s*<\?xml[^>]*?encoding\s*=\s*["']([A-Za-z0-9._:-]+)["']""")
+
+def _kml_text(src):
+    """
+    İkili akış → metin akışı. XML bildirimindeki kodlama (windows-1254,
+    ISO-8859-9 ...) kullanılır; bildirim yoksa / tanınmıyorsa UTF-8.
+    Bozuk baytlar (ör. UTF-8 bildirip cp1254 yazan dosyalar) dosyayı düşürmez: "�" olur.
+    UTF-16/32 (BOM) baytları olduğu gibi expat'a bırakılır.
+    """
+    if not hasattr(src, "peek"): src = io.BufferedReader(src)
+    head = src.peek(1024)[:1024]
+    if head.startswith((codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE,
+                        codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return src
+    m = _XML_ENC_RE.match(head); enc = "utf-8-sig"
+    if m:
+        try:
+            name = codecs.lookup(m[1].decode("ascii")).name
+            if name != "utf-8": enc = name
+        except LookupError: pass
+    return io.TextIOWrapper(src, encoding=enc, errors="replace")
+
+def iter_kml(src):
+    """
+    Akışlı KML okuyucu (iterparse): Placemark'lar geldikçe üretilir, işlenen
+    elemanlar ağaçtan silinir → bellek dosya boyutundan bağımsız kalır.
+    src: ikili dosya nesnesi (zip üyesi dahil), bytes veya str
+    """
+    if isinstance(src, str): src = io.StringIO(src)
+    else: src = _kml_text(io.BytesIO(src) if isinstance(src, bytes) else src)
+    stack = []; idx = 0
+    for ev, el in ET.iterparse(src, events=("start", "end")):
+        if ev == "start":
+            stack.append(el); continue
+        stack.pop()
+        if _local(el.tag) != "Placemark": continue
+        props, geom = _kml_placemark(el)
+        if stack and len(stack[-1]) and stack[-1][-1] is el: del stack[-1][-1]
+        el.clear()
+        if geom is not None:
+            yield {"id": str(idx), "props": props, "geom": geom}; idx += 1
+
 def parse_kml(text):
-    NS="http://www.opengis.net/kml/2.2"; root=ET.fromstring(text); out=[]; idx=0
-    for pm in root.iter(f"{{{NS}}}Placemark"):
-        ne=pm.find(f"{{{NS}}}name")
-        props={"name":(ne.text or "") if ne is not None else ""}
-        for dd in pm.iter(f"{{{NS}}}Data"):
-            k=dd.get("name",""); ve=dd.find(f"{{{NS}}}value")
-            if k and ve is not None: props[k]=ve.text or ""
-        for poly in pm.iter(f"{{{NS}}}Polygon"):
-            oc=poly.find(f".//{{{NS}}}outerBoundaryIs//{{{NS}}}coordinates")
-            if oc is None or not oc.text: continue
-            coords=[]
-            for tok in oc.text.strip().split():
-                p=tok.split(",")
-                if len(p)>=2:
-                    try: coords.append([float(p[0]),float(p[1])])
-                    except: pass
-            if len(coords)>=3:
-                if coords[0]!=coords[-1]: coords.append(coords[0])
-                out.append({"id":str(idx),"props":props,
-                            "geom":{"type":"Polygon","coordinates":[coords]}}); idx+=1
-    return out
+    return list(iter_kml(text))
 
-def load_file(uf):
+SHP_POLYGON_TYPES = (5, 15, 25)   # POLYGON, POLYGONZ, POLYGONM
+
+def _shp_encoding(z, cpg_name):
+    """.cpg içeriği → Python codec adı (yoksa/tanınmazsa utf-8)"""
+    if not cpg_name: return "utf-8"
+    enc = z.read(cpg_name).decode("ascii", "ignore").strip()
+    enc = f"cp{enc}" if enc.isdigit() else enc
+    try: return codecs.lookup(enc).name
+    except LookupError: return "utf-8"
+
+def iter_shp(z, shp, start=0, layer=None):
+    """
+    Zip içindeki bir shapefile katmanını akışlı oku (.shp/.shx/.dbf doğrudan
+    zip üyesi olarak, geçici dizin yok). Sadece poligon kayıtları üretilir.
+    layer: birden çok katman varsa "katman" özniteliği olarak eklenir
+    """
+    import shapefile as sf
+    base  = shp[:-4].lower()
+    names = {n.lower(): n for n in z.namelist()}
+    dbf   = names.get(base + ".dbf")
+    if not dbf: raise ValueError(f"{shp}: .dbf yok")
+    shx   = names.get(base + ".shx")
+    with sf.Reader(shp=z.open(shp), dbf=z.open(dbf), shx=z.open(shx) if shx else None,
+                   encoding=_shp_encoding(z, names.get(base + ".cpg")),
+                   encodingErrors="replace") as r:
+        fields = [f[0] for f in r.fields[1:]]
+        idx = start
+        for sr in r.iterShapeRecords():
+            if sr.shape.shapeType not in SHP_POLYGON_TYPES: continue
+            props = dict(zip(fields, sr.record))
+            if layer: props["katman"] = layer
+            shp_ = sr.shape   # tek parçalı poligon: halka yönü hesabı gereksiz
+            geom = ({"type": "Polygon", "coordinates": [shp_.points]} if len(shp_.parts) == 1
+                    else shp_.__geo_interface__)
+            yield {"id": str(idx), "props": props, "geom": geom}
+            idx += 1
+
+def iter_file(uf):
+    """Yüklenen dosyadan parselleri akışlı üret (KML/KMZ zip üyesinden doğrudan)"""
     ext=uf.name.rsplit(".",1)[-1].lower()
-    if ext in("geojson","json"): return parse_geojson(json.loads(uf.read()))
-    if ext=="kml": return parse_kml(uf.read().decode("utf-8","ignore"))
+    if ext in("geojson","json"): yield from parse_geojson(json.loads(uf.read())); return
+    if ext=="kml": yield from iter_kml(uf); return
     if ext=="kmz":
-        with zipfile.ZipFile(io.BytesIO(uf.read())) as z:
+        with zipfile.ZipFile(uf) as z:
             kn=next((n for n in z.namelist() if n.lower().endswith(".kml")),None)
             if not kn: raise ValueError("KMZ içinde KML yok")
-            return parse_kml(z.read(kn).decode("utf-8","ignore"))
+            with z.open(kn) as fh: yield from iter_kml(fh)
+        return
     if ext=="zip":
-        raw=uf.read()
-        with tempfile.TemporaryDirectory() as td:
-            with zipfile.ZipFile(io.BytesIO(raw)) as z: z.extractall(td)
-            for fn in os.listdir(td):
-                fp=os.path.join(td,fn)
-                if fn.endswith(".shp"):
-                    import shapefile as sf
-                    r=sf.Reader(fp); fields=[f[0] for f in r.fields[1:]]
-                    return [{"id":str(i),"props":dict(zip(fields,sr.record)),
-                             "geom":sr.shape.__geo_interface__}
-                            for i,sr in enumerate(r.shapeRecords())
-                            if "Polygon" in sr.shape.__geo_interface__.get("type","")]
-                if fn.endswith(".kml"):
-                    return parse_kml(open(fp,encoding="utf-8",errors="ignore").read())
-                if fn.endswith((".geojson",".json")):
-                    return parse_geojson(json.load(open(fp,encoding="utf-8")))
+        # Arşiv diske açılmaz: üyeler zip içinden dosya nesnesi olarak okunur
+        with zipfile.ZipFile(uf) as z:
+            names=[n for n in z.namelist()
+                   if not n.startswith("__MACOSX/") and not n.endswith("/")]
+            shps=sorted(n for n in names if n.lower().endswith(".shp"))
+            if shps:
+                idx=0
+                for shp in shps:
+                    layer=shp.rsplit("/",1)[-1][:-4] if len(shps)>1 else None
+                    for f in iter_shp(z,shp,idx,layer):
+                        yield f; idx+=1
+                return
+            kn=next((n for n in names if n.lower().endswith(".kml")),None)
+            if kn:
+                with z.open(kn) as fh: yield from iter_kml(fh)
+                return
+            gj=next((n for n in names if n.lower().endswith((".geojson",".json"))),None)
+            if gj:
+                with z.open(gj) as fh: yield from parse_geojson(json.load(fh))
+                return
     raise ValueError(f"Desteklenmeyen: {ext}")
 
+def load_file(uf):
+    return list(iter_file(uf))
+
+# ── Parsel deposu (sütunsal) ──────────────────────────────────
+def _present(v):
+    return v is not None and not (isinstance(v, float) and v != v)
+
+# Sadeleştirme kademeleri (tolerans, metre). 0 = sadece koordinat nicemleme.
+# Harita, zoom'daki piksel boyutunu aşmayan en kaba kademeyi; arka uç ise
+# 10 m Sentinel-2 pikselinin 1/5'ini (BACKEND_TOL_M) kullanır.
+GEOM_TIERS_M  = (0, 0.5, 2, 8, 32)
+BACKEND_TOL_M = 2
+
+def simplify_geoms(geoms, tol_m):
+    """
+    Topolojiyi koruyarak sadeleştir + koordinatları toleransa uygun ondalığa
+    yuvarla (0 m → 7 hane ≈ 1 cm, kaba kademeler 5-6 hane). Boşalan ya da
+    geçersizleşen parseller orijinal geometrisini korur.
+    """
+    tol = tol_m / 111320.0
+    d = 7 if tol_m <= 0 else int(min(7, max(5, math.ceil(-math.log10(tol / 4)))))
+    g = shapely.simplify(geoms, tol, preserve_topology=True) if tol_m > 0 else geoms
+    q = shapely.transform(g, lambda c: np.round(c, d))
+    bad = shapely.is_empty(q) | ~shapely.is_valid(q)
+    q[bad] = geoms[bad]
+    return q
+
+def tier_for_zoom(zoom, lat):
+    """Web Mercator piksel boyutunu (m) aşmayan en büyük tolerans kademesi"""
+    px = 156543.03 * math.cos(math.radians(lat)) / 2 ** zoom
+    return max(t for t in GEOM_TIERS_M if t <= px)
+
+def geoms_from_geojson(gs):
+    """
+    GeoJSON geometri listesi → shapely dizisi. Tek halkalı poligonlar (parsellerin
+    çoğu) from_ragged_array ile toplu kurulur; diğerleri shape() ile.
+    """
+    out = np.empty(len(gs), dtype=object)
+    simple = []; rings = []
+    for i, g in enumerate(gs):
+        if g["type"] == "Polygon" and len(g["coordinates"]) == 1 and len(g["coordinates"][0]) >= 4:
+            r = np.asarray(g["coordinates"][0], dtype=float)
+            if r.ndim == 2 and r.shape[1] >= 2:
+                simple.append(i); rings.append(r[:, :2]); continue
+        out[i] = shape(g)
+    if simple:
+        ring_off = np.concatenate([[0], np.cumsum([len(r) for r in rings])])
+        out[simple] = shapely.from_ragged_array(
+            shapely.GeometryType.POLYGON, np.vstack(rings),
+            (ring_off, np.arange(len(rings) + 1)))
+    return out
+
+SEARCH_SHOW = 200   # arama sonuçlarından widget'a konan en fazla seçenek
+MSEL_MAX    = 500   # seçim bundan büyükse manuel multiselect yerine "ekle" akışı
+FILTER_MAX_CARD = 2000   # filtre sütunu olarak sunulacak en fazla benzersiz değer
+
+class AttrIndex:
+    """
+    Öznitelik ters indeksi — yüklemede bir kez kurulur. Her sütun sözlük
+    kodlanır (sıralı benzersiz değerler + parsel başına int32 kod, -1 = boş);
+    değer → parsel listeleri CSR biçiminde (order/offs) tutulur. Filtre,
+    çoklu değer seçimi ve arama bu dizilerden dilimlerle yanıtlanır.
+    """
+    def __init__(self, ids, attrs):
+        self.n = len(ids)
+        self.cols = {}                       # ad → (uniques, codes, order, offs)
+        self.kinds = {}; self.card = {}
+        for c in attrs.columns:
+            col = attrs[c]
+            self.kinds[c] = pd.api.types.infer_dtype(col, skipna=True)
+            ok = col.notna().to_numpy()
+            codes = np.full(self.n, -1, dtype=np.int32)
+            codes[ok], uniq = pd.factorize(col[ok].astype(str), sort=True)
+            self.cols[c] = self._csr(np.asarray(uniq, dtype=object), codes)
+            self.card[c] = len(uniq)
+        self._ids = self._csr(np.asarray(ids, dtype=object), np.arange(self.n, dtype=np.int32))
+        self._hay = {}
+
+    @staticmethod
+    def _csr(uniq, codes):
+        order = np.argsort(codes, kind="stable").astype(np.int32)
+        cnt = np.bincount(codes[codes >= 0], minlength=len(uniq))
+        offs = np.concatenate([[0], np.cumsum(cnt)]) + int((codes < 0).sum())
+        return uniq, codes, order, offs
+
+    @property
+    def str_keys(self):
+        """Tüm değerleri metin (veya boş) olan sütunlar"""
+        return [str(c) for c, k in self.kinds.items() if k in ("string", "empty")]
+
+    def values(self, col):
+        """Filtre seçenekleri: sıralı benzersiz değerler (boş metin hariç)"""
+        return [u for u in self.cols[col][0] if u != ""]
+
+    def value(self, col, i):
+        uniq, codes = self.cols[col][:2]
+        return uniq[codes[i]] if codes[i] >= 0 else ""
+
+    def _rows(self, entry, codes):
+        _, _, order, offs = entry
+        if not len(codes): return np.empty(0, dtype=np.int32)
+        return np.sort(np.concatenate([order[offs[k]:offs[k + 1]] for k in codes]))
+
+    def select(self, col, vals):
+        """col ∈ vals olan parsellerin konumları (sıralı)"""
+        uniq = self.cols[col][0]
+        k = np.searchsorted(uniq, vals) if len(uniq) else np.empty(0, int)
+        k = [int(j) for j, v in zip(k, vals) if j < len(uniq) and uniq[j] == v]
+        return self._rows(self.cols[col], k)
+
+    def mask(self, col, vals):
+        """select'in bool maske (bitmap) karşılığı — filtre birleştirme için"""
+        m = np.zeros(self.n, bool); m[self.select(col, vals)] = True
+        return m
+
+    def _haystack(self, key):
+        """Sözlükteki değerler tek küçük harf metinde ("\n" ayraçlı) + başlangıç ofsetleri"""
+        h = self._hay.get(key)
+        if h is None:
+            uniq = (self._ids if key is None else self.cols[key])[0]
+            low = [str(u).lower().replace("\n", " ") for u in uniq]
+            starts = np.cumsum([0] + [len(x) + 1 for x in low[:-1]]) if low else np.empty(0, int)
+            h = self._hay[key] = ("\n".join(low), starts)
+        return h
+
+    def search(self, text, limit=None):
+        """
+        id veya metin öznitelikte text geçen parseller (büyük/küçük harf
+        duyarsız). Arama sütun başına sözlük üzerinde yapılır, sonra CSR ile
+        parsellere açılır. id eşleşmeleri önce gelir.
+        """
+        q = text.strip().lower()
+        if not q or "\n" in q: return np.empty(0, dtype=np.int32)
+        out = []; seen = np.zeros(self.n, bool)
+        for key in [None] + [c for c in self.cols if self.kinds[c] in ("string", "empty", "mixed", "mixed-integer", "integer")]:
+            hay, starts = self._haystack(key)
+            hits = [m.start() for m in re.finditer(re.escape(q), hay)]
+            if not hits: continue
+            k = np.unique(np.searchsorted(starts, hits, side="right") - 1)
+            rows = self._rows(self._ids if key is None else self.cols[key], k)
+            rows = rows[~seen[rows]]; seen[rows] = True; out.append(rows)
+            if limit and seen.sum() >= limit: break
+        rows = np.concatenate(out) if out else np.empty(0, dtype=np.int32)
+        return rows[:limit] if limit else rows
+
+class ParcelStore:
+    """
+    Yüklenen parsel katmanı — sütunsal: shapely 2 geometri dizisi, pandas
+    öznitelik tablosu, önceden hesaplanmış bbox / merkez / alan / geometri özeti.
+    Yüklemede bir kez kurulur; harita, seçim, tablo ve export dizilerle çalışır.
+    Uzak işler için GeoJSON feature dict'leri sadece istenen parseller için üretilir.
+    """
+    def __init__(self, ids, geoms, attrs):
+        self.ids   = [str(i) for i in ids]
+        self.pos   = {fid: i for i, fid in enumerate(self.ids)}
+        self.geoms = np.empty(len(self.ids), dtype=object); self.geoms[:] = list(geoms)
+        self.attrs = attrs.reset_index(drop=True); self.attrs.columns = self.attrs.columns.map(str)
+        self.aidx  = AttrIndex(self.ids, self.attrs)
+        self.bounds    = shapely.bounds(self.geoms).reshape(-1, 4)
+        self.centroids = shapely.centroid(self.geoms)
+        self.cxy       = shapely.get_coordinates(self.centroids).reshape(-1, 2)
+        self.areas     = areas_dk(self.geoms)
+        self.hashes    = geom_hashes(self.geoms) if len(self.ids) else []
+        # Mekânsal indeks: çizimle seçim, görünüm kırpma, bbox sorguları O(log n)
+        self.tree  = shapely.STRtree(self.geoms)
+        self.ctree = shapely.STRtree(self.centroids)
+        self._tiers = {}
+
+    @classmethod
+    def from_features(cls, feats):
+        """feats: {"id","props","geom"} dizisi veya akışı — tek geçişte tüketilir"""
+        ids = []; geoms = []; props = []
+        for f in feats:
+            ids.append(f["id"]); geoms.append(f["geom"]); props.append(f["props"])
+        return cls(ids, geoms_from_geojson(geoms), pd.DataFrame(props, dtype=object))
+
+    def __len__(self): return len(self.ids)
+
+    def tier(self, tol_m):
+        """Sadeleştirilmiş/nicemlenmiş geometri dizisi — kademe başına ilk istekte kurulur"""
+        g = self._tiers.get(tol_m)
+        if g is None:
+            g = self._tiers[tol_m] = simplify_geoms(self.geoms, tol_m)
+        return g
+
+    def index(self, ids):
+        """parsel id'leri → konum dizisi (bilinmeyenler atlanır)"""
+        return np.array([self.pos[i] for i in ids if i in self.pos], dtype=int)
+
+    def total_bounds(self, idx=None):
+        b = self.bounds if idx is None else self.bounds[idx]
+        return [b[:, 0].min(), b[:, 1].min(), b[:, 2].max(), b[:, 3].max()]
+
+    def props(self, i):
+        return {k: v for k, v in self.attrs.iloc[i].items() if _present(v)}
+
+    def records(self, idx):
+        """Toplu öznitelik satırları (eksik anahtarlar atılır) — her konum için bir dict"""
+        if not len(self.attrs.columns): return [{} for _ in idx]   # to_dict("records") → []
+        return [{k: v for k, v in r.items() if _present(v)}
+                for r in self.attrs.iloc[idx].to_dict("records")]
+
+    def feature(self, i, props=None):
+        """Eski {"id","props","geom"} sözleşmesi — sadece uzak işler için (arka uç kademesi)"""
+        return {"id": self.ids[i], "props": self.props(i) if props is None else props,
+                "geom": mapping(self.tier(BACKEND_TOL_M)[i]), "_h": self.hashes[i],
+                "_b": self.bounds[i].tolist()}
+
+    def features_at(self, idx, props=True):
+        """Konumlar → feature dict'leri; props=False → öznitelik kopyalanmaz (arka uç işleri)"""
+        recs = self.records(idx) if props else ({} for _ in idx)
+        return [self.feature(i, p) for i, p in zip(idx, recs)]
+
+    def features(self, ids):
+        return self.features_at(self.index(ids))
+
+    def label(self, i):
+        p = self.props(i)
+        return f"#{self.ids[i]} {str(next(iter(p.values())))[:15]}" if p else f"#{self.ids[i]}"
+
+    @cached_property
+    def fingerprint(self):
+        """İçerik parmak izi: id + geometri özeti + öznitelikler (memo anahtarları için)"""
+        h = hashlib.sha1("\0".join(self.ids).encode())
+        h.update("".join(self.hashes).encode())
+        h.update(pd.util.hash_pandas_object(self.attrs.astype(str), index=False).to_numpy().tobytes())
+        h.update("\0".join(self.attrs.columns).encode())
+        return h.hexdigest()
+
+    @property
+    def str_keys(self):
+        """Tüm değerleri metin (veya boş) olan öznitelik sütunları"""
+        return self.aidx.str_keys
+
+    def query_bbox(self, bbox):
+        """[west, south, east, north] ile kesişen parsellerin konumları (STRtree)"""
+        return np.sort(self.tree.query(shapely.box(*bbox)))
+
+    def query_centroids(self, bbox):
+        """Merkezi [west, south, east, north] içinde kalan parsellerin konumları"""
+        return np.sort(self.ctree.query(shapely.box(*bbox)))
+
+    def match(self, geom):
+        """Çizilen alanla kesişen / merkezini içeren parsellerin id'leri (STRtree + hazır geometri)"""
+        shapely.prepare(geom)
+        hit = np.union1d(self.tree.query(geom, predicate="intersects"),
+                         self.ctree.query(geom, predicate="contains"))
+        return [self.ids[i] for i in hit]
+
+# ── NDVI sonuç matrisi (parsel × hedef tarih) ─────────────────
+def ndvi_classes(v):
+    """NDVI dizisi → durum etiketleri (Ekili / Geçiş / Boş/Nadas / "")"""
+    v = np.asarray(v, dtype=float)
+    return np.select([v > 0.35, v > 0.15, ~np.isnan(v)], ["Ekili", "Geçiş", "Boş/Nadas"], "")
+
+class NdviResults:
+    """
+    Analiz sonuçları — satırlar ParcelStore konumlarıyla hizalı, sütunlar hedef
+    tarihler. vals: float32 (NaN = değer yok), act: gerçek sahne tarihinin
+    actuals listesindeki indeksi (-1 = hesaplanmadı). Metrik, sınıflama, grafik
+    ve export bu dizilerden vektörel hesaplanır.
+    """
+    def __init__(self, ids=()):
+        self.ids = [str(i) for i in ids]
+        self.pos = {fid: i for i, fid in enumerate(self.ids)}
+        self.dates = []; self.dpos = {}
+        self.vals = np.full((len(self.ids), 0), np.nan, dtype=np.float32)
+        self.act  = np.full((len(self.ids), 0), -1, dtype=np.int32)
+        self.actuals = []; self.apos = {}
+
+    def __len__(self): return len(self.ids)
+
+    def _col(self, date):
+        j = self.dpos.get(date)
+        if j is None:
+            j = self.dpos[date] = len(self.dates); self.dates.append(date)
+            n = len(self.ids)
+            self.vals = np.hstack([self.vals, np.full((n, 1), np.nan, dtype=np.float32)])
+            self.act  = np.hstack([self.act, np.full((n, 1), -1, dtype=np.int32)])
+        return j
+
+    def put(self, date, vals, actual):
+        """vals: {fid: ndvi|None} — bilinmeyen parseller atlanır"""
+        rows = [(self.pos[f], v) for f, v in vals.items() if f in self.pos]
+        if not rows: return
+        j = self._col(date)
+        a = self.apos.get(actual)
+        if a is None:
+            a = self.apos[actual] = len(self.actuals); self.actuals.append(actual)
+        r = np.fromiter((i for i, _ in rows), dtype=np.intp, count=len(rows))
+        self.vals[r, j] = np.array([np.nan if v is None else v for _, v in rows], dtype=np.float32)
+        self.act[r, j] = a
+
+    def done(self, idx, date):
+        """idx parselleri için date hesaplandı mı (değer boş olsa da)"""
+        j = self.dpos.get(date)
+        return np.zeros(len(idx), bool) if j is None else self.act[idx, j] >= 0
+
+    def block(self, idx, dates):
+        """
+        (values, actuals): idx × dates float64 (NaN = yok) ve gerçek tarih
+        dizisi (object; hesaplanmamış hücrelerde None).
+        """
+        idx = np.asarray(idx, dtype=np.intp)
+        v = np.full((len(idx), len(dates)), np.nan)
+        a = np.full((len(idx), len(dates)), None, dtype=object)
+        acts = np.array(self.actuals + [None], dtype=object)   # -1 → None
+        for k, d in enumerate(dates):
+            j = self.dpos.get(d)
+            if j is None or not len(idx): continue
+            v[:, k] = self.vals[idx, j]
+            a[:, k] = acts[self.act[idx, j]]
+        return v, a
+
+    def actuals_in(self, idx, date):
+        """idx parsellerinde date için kullanılan gerçek tarihler (ilk görülme sırası)"""
+        j = self.dpos.get(date)
+        if j is None or not len(idx): return [None]
+        a = self.act[idx, j]
+        u, first = np.unique(a, return_index=True)
+        return [self.actuals[x] if x >= 0 else None for x in u[np.argsort(first)]]
+
+    def column(self, date, idx=None):
+        idx = np.arange(len(self.ids)) if idx is None else idx
+        return self.block(idx, [date])[0][:, 0]
+
+def init_session():
+    """Oturum varsayılanları — yalnızca arayüzde (batch.py session_state kullanmaz)"""
+    for k, v in SESSION_DEFAULTS.items():
+        if k not in st.session_state:
+            st.session_state[k] = copy.deepcopy(v)
+    # isinstance kullanılmaz: her rerun'da sınıf yeniden tanımlanır
+    if st.session_state.ndvi_results is None:
+        st.session_state.ndvi_results = NdviResults()
+
+# ── Rerun'lar arası memo (parmak izi anahtarlı) ───────────────
+MEMO_MAX = 32
+
+def memo(name, key, fn):
+    """
+    Oturum içi LRU: (name, key) aynıysa fn yeniden çalışmaz. key yalnızca
+    parmak izlerinden oluşur (parsel seti, seçim, sonuç sürümü, tarih...).
+    """
+    box = st.session_state.setdefault("_memo", OrderedDict())
+    k = (name, key)
+    metrics().hit("memo", k in box)
+    if k in box:
+        box.move_to_end(k); return box[k]
+    v = box[k] = fn()
+    while len(box) > MEMO_MAX: box.popitem(last=False)
+    return v
+
+def sel_fingerprint(ids):
+    return hashlib.sha1("\0".join(ids).encode()).hexdigest()
+
+def results_changed(dates=None):
+    """ndvi_results değişti: dates verilirse yalnız o tarihlerin sürümü artar, yoksa hepsi"""
+    ss = st.session_state
+    if dates is None: ss.ndvi_epoch += 1
+    else:
+        for d in dates: ss.ndvi_ver[d] = ss.ndvi_ver.get(d, 0) + 1
+
+def results_key(dates):
+    """Verilen tarihlerin sonuç sürümü — sadece etkilenen artefaktlar yeniden kurulur"""
+    return (st.session_state.ndvi_epoch,) + tuple(st.session_state.ndvi_ver.get(d, 0) for d in dates)
+
 # ── Harita ────────────────────────────────────────────────────
-def build_map(feats, sel_ids, act_date, ndvi_res, sent_date):
-    m = folium.Map(location=st.session_state.map_center,
-                   zoom_start=st.session_state.map_zoom,
+# Parsel katmanı: tek FeatureCollection, stil/tooltip istemcide özelliklerden üretilir
+# (id, v=NDVI, s=seçili, a=gerçek tarih, t=ilk 5 öznitelik)
+_NDVI_FILL_JS = """
+    const breaks = %s;
+    function ndviFill(v) {
+        for (const [lim, c] of breaks) { if (v < lim) return c; }
+        return "%s";
+    }
+""" % (json.dumps(NDVI_BREAKS), NDVI_TOP)
+
+_PARCEL_JS = """
+function(feature, layer) {""" + _NDVI_FILL_JS + """
+    const p = feature.properties, v = p.v, sel = p.s === 1, has = v !== null && v !== undefined;
+    layer.setStyle({fillColor: has ? ndviFill(v) : (sel ? "#4ade80" : "#22c55e"),
+                    fillOpacity: has ? 0.65 : (sel ? 0.25 : 0.08),
+                    color: sel ? "#ffff00" : "#4ade80", weight: sel ? 3 : 1.5});
+    const tip = ["<b>#" + p.id + "</b>"];
+    for (const [k, x] of p.t) tip.push(k + ": " + x);
+    if (has) {
+        tip.push("<b>NDVI: " + v.toFixed(3) + "</b>");
+        tip.push("<b>" + (v > 0.35 ? "🌾 Ekili" : v > 0.15 ? "🟡 Geçiş" : "🌱 Boş/Nadas") + "</b>");
+        if (p.a) tip.push("📅 Gerçek: " + p.a);
+    }
+    layer.bindTooltip(tip.join("<br>"));
+}
+"""
+
+# Özet hücreleri: n=parsel sayısı, v=ortalama NDVI, k=seçili sayısı
+_CELL_JS = """
+function(feature, layer) {""" + _NDVI_FILL_JS + """
+    const p = feature.properties, has = p.v !== null && p.v !== undefined;
+    layer.setStyle({fillColor: has ? ndviFill(p.v) : "#22c55e", fillOpacity: has ? 0.6 : 0.15,
+                    color: p.k > 0 ? "#ffff00" : "#4ade80", weight: 1});
+    const tip = ["<b>" + p.n + " parsel</b>"];
+    if (p.k > 0) tip.push(p.k + " seçili");
+    if (has) tip.push("<b>Ort. NDVI: " + p.v.toFixed(3) + "</b>");
+    layer.bindTooltip(tip.join("<br>"));
+}
+"""
+
+MAP_MAX_PARCELS = 4000   # görünümde tam ayrıntıyla çizilecek üst sınır; üstü hücre özeti
+MAP_GRID        = 32     # özet modunda görünüm genişliği boyunca yaklaşık hücre sayısı
+MAP_VIEW_PAD    = 0.25   # katman görünümü payı (görünüm boyuna oran); içinde kalan kaydırma yeniden kurmaz
+
+def layer_view(view):
+    """
+    Tarayıcı görünümü (west, south, east, north, zoom) → katman görünümü:
+    her yana yaklaşık MAP_VIEW_PAD payı, kenarlar 2'nin kuvveti adımlı ızgaraya
+    oturtulur. Görünüm aynı zoom'da bu kutunun içinde kaldıkça katman (ve memo
+    anahtarı) değişmez.
+    """
+    w, s, e, n, zoom = view
+    step = 2.0 ** math.floor(math.log2(max(e - w, n - s, 1e-9) * MAP_VIEW_PAD))
+    return (math.floor(w / step - 1) * step, math.floor(s / step - 1) * step,
+            math.ceil(e / step + 1) * step, math.ceil(n / step + 1) * step, zoom)
+
+def view_inside(view, lv):
+    """Tarayıcı görünümü katman görünümünün (lv) içinde ve aynı zoom'da mı"""
+    return (lv is not None and view[4] == lv[4] and lv[0] <= view[0] and lv[1] <= view[1]
+            and view[2] <= lv[2] and view[3] <= lv[3])
+
+def parcel_collection(feats, idx, sel_ids, act_date, ndvi_res, zoom=None):
+    """
+    idx konumlarındaki parseller için tek GeoJSON FeatureCollection (str).
+    Geometriler zoom'a uygun sadeleştirme kademesinden shapely.to_geojson ile
+    toplu yazılır; özellikler yalnızca stil/tooltip için gereken küçük alanlardır.
+    """
+    sel_ids = set(sel_ids)
+    idx = np.asarray(idx, dtype=int)
+    if not len(idx): return '{"type":"FeatureCollection","features":[]}'
+    b = feats.total_bounds(idx)
+    tol = tier_for_zoom(zoom, (b[1] + b[3]) / 2) if zoom is not None else 0
+    geo = shapely.to_geojson(feats.tier(tol)[idx])
+    cols = [str(c) for c in feats.attrs.columns]
+    vals = feats.attrs.to_numpy()
+    nv, na = ndvi_res.block(idx, [act_date]) if act_date else (np.full((len(idx), 1), np.nan), None)
+    parts = []
+    for k, (g, i) in enumerate(zip(geo, idx)):
+        fid = feats.ids[i]
+        v = nv[k, 0]; act = na[k, 0] if na is not None else None
+        p = {"id": fid, "s": int(fid in sel_ids),
+             "v": None if v != v else round(float(v), 4),
+             "a": act if v == v and act and act != act_date else None,
+             "t": [[k, str(x)] for k, x in zip(cols, vals[i]) if _present(x)][:5]}
+        parts.append('{"type":"Feature","geometry":%s,"properties":%s}'
+                     % (g, json.dumps(p, ensure_ascii=False, default=str)))
+    return '{"type":"FeatureCollection","features":[' + ",".join(parts) + "]}"
+
+def cell_collection(feats, idx, sel_ids, act_date, ndvi_res, view):
+    """
+    Düşük zoom özeti: idx parselleri merkezlerine göre kare ızgaraya atanır,
+    hücre başına sayı / ortalama NDVI / seçili sayısı (np.bincount). Hücre
+    boyu 2'nin kuvvetine yuvarlanır — kaydırmada ızgara sabit kalır.
+    """
+    idx = np.asarray(idx, dtype=int)
+    if not len(idx): return '{"type":"FeatureCollection","features":[]}', 0
+    w, s, e, n = view
+    cell = 2.0 ** round(math.log2(max(e - w, n - s, 1e-9) / MAP_GRID))
+    xy = feats.cxy[idx]
+    ij = np.floor(xy / cell).astype(np.int64)
+    keys, inv = np.unique(ij, axis=0, return_inverse=True)
+    inv = inv.ravel(); m = len(keys)
+    v = ndvi_res.column(act_date, idx) if act_date else np.full(len(idx), np.nan)
+    ok = ~np.isnan(v)
+    cnt  = np.bincount(inv, minlength=m)
+    vn   = np.bincount(inv[ok], minlength=m)
+    vs   = np.bincount(inv[ok], weights=v[ok], minlength=m)
+    sel = np.zeros(len(feats), bool); sel[feats.index(sel_ids)] = True
+    ks   = np.bincount(inv, weights=sel[idx], minlength=m)
+    parts = []
+    for c in range(m):
+        x0, y0 = float(keys[c][0] * cell), float(keys[c][1] * cell); x1, y1 = x0 + cell, y0 + cell
+        p = {"n": int(cnt[c]), "k": int(ks[c]),
+             "v": round(float(vs[c] / vn[c]), 4) if vn[c] else None}
+        parts.append('{"type":"Feature","geometry":{"type":"Polygon","coordinates":'
+                     '[[[%r,%r],[%r,%r],[%r,%r],[%r,%r],[%r,%r]]]},"properties":%s}'
+                     % (x0, y0, x1, y0, x1, y1, x0, y1, x0, y0, json.dumps(p)))
+    return '{"type":"FeatureCollection","features":[' + ",".join(parts) + "]}", m
+
+@timed("map.layer")
+def parcel_layer(feats, sel_ids, act_date, ndvi_res, view=None):
+    """
+    Görünüme göre kırpılmış parsel katmanı (FeatureGroup) + durum metni.
+    view: layer_view çıktısı (west, south, east, north, zoom) — None ise tüm katman.
+    Görünümdeki parseller MAP_MAX_PARCELS'i aşarsa ızgara hücre özeti çizilir.
+    """
+    fg = folium.FeatureGroup(name="Parseller")
+    if not feats: return fg, ""
+    if view is None:
+        bbox, zoom = feats.total_bounds(), None
+    else:
+        bbox, zoom = list(view[:4]), view[4]
+    idx = feats.query_bbox(bbox)
+    if len(idx) <= MAP_MAX_PARCELS:
+        folium.GeoJson(parcel_collection(feats, idx, sel_ids, act_date, ndvi_res, zoom),
+                       style_function=None,
+                       on_each_feature=folium.JsCode(_PARCEL_JS)).add_to(fg)
+        return fg, f"Görünümde {len(idx)} / {len(feats)} parsel"
+    cidx = feats.query_centroids(bbox)
+    fc, m = cell_collection(feats, cidx, sel_ids, act_date, ndvi_res, bbox)
+    folium.GeoJson(fc, style_function=None,
+                   on_each_feature=folium.JsCode(_CELL_JS)).add_to(fg)
+    return fg, f"Görünümde {len(cidx)} parsel — {m} hücre özeti (yakınlaştırın)"
+
+@timed("map.build")
+def build_map(sent_date, center=None, zoom=None):
+    """Taban harita (uydu, çizim, WMS). Parseller parcel_layer ile ayrı gelir."""
+    m = folium.Map(location=center or st.session_state.map_center,
+                   zoom_start=zoom or st.session_state.map_zoom,
                    tiles="https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}",
                    attr="Google Satellite", max_zoom=21)
     Draw(export=False,
@@ -347,389 +1953,526 @@ def build_map(feats, sel_ids, act_date, ndvi_res, sent_date):
             layers="NDVI", fmt="image/png", transparent=True, version="1.3.0",
             extra_params={"time":f"{sent_date}/{sent_date}","maxcc":80},
             opacity=0.55, overlay=True, control=True).add_to(m)
-    for feat in feats:
-        fid=feat["id"]; is_sel=fid in sel_ids
-        val=ndvi_res.get(fid,{}).get(act_date,{}).get("ndvi") if act_date else None
-        fc=ndvi_color(val) if val is not None else ("#4ade80" if is_sel else "#22c55e")
-        fo=0.65 if val is not None else (0.25 if is_sel else 0.08)
-        tip=[f"<b>#{fid}</b>"]+[f"{k}: {v}" for k,v in list(feat["props"].items())[:5]]
-        if val is not None:
-            act=ndvi_res.get(fid,{}).get(act_date,{}).get("actual_date",act_date)
-            tip+=[f"<b>NDVI: {val:.3f}</b>",f"<b>{ndvi_status(val)}</b>"]
-            if act and act!=act_date: tip.append(f"📅 Gerçek: {act}")
-        folium.GeoJson(feat["geom"],
-            style_function=lambda x,fc=fc,fo=fo,is_sel=is_sel:{
-                "fillColor":fc,"fillOpacity":fo,
-                "color":"#ffff00" if is_sel else "#4ade80","weight":3 if is_sel else 1.5},
-            tooltip=folium.Tooltip("<br>".join(tip))).add_to(m)
     folium.LayerControl().add_to(m)
     return m
 
 # ── Export ────────────────────────────────────────────────────
+EXPORT_CHUNK = 2000   # parça başına parsel — export belleği rapor boyundan bağımsız
+REPORT_SHEETS = {"rows": ("Analiz", "1E5631"), "ts": ("Zaman_Serisi", "1A3A6A")}   # sayfa, başlık rengi
+
+def _base_frame(feats, idx):
+    """Parsel_# + öznitelikler + Alan_Dekar"""
+    at = feats.attrs.iloc[idx].reset_index(drop=True)
+    at.insert(0, "Parsel_#", [feats.ids[i] for i in idx])
+    at["Alan_Dekar"] = feats.areas[idx].astype(float)
+    return at
+
+def _ndvi_col(date, act):
+    return f"NDVI_{date}(ger:{act})" if act and act!=date else f"NDVI_{date}"
+
+def report_columns(kind, feats, idx, ndvi_res, dates):
+    """
+    Raporun sabit şeması — seçimde tamamen boş öznitelikler atılır, parsel
+    bazlı raporda gerçek tarihi farklı parseller ayrı NDVI sütunu alır.
+    """
+    has = feats.attrs.iloc[idx].notna().any().to_numpy() if len(idx) else []
+    attr = [c for c, ok in zip(feats.attrs.columns, has) if ok]
+    if kind == "ts":
+        return ["Parsel_#", *attr, "Alan_Dekar", "Hedef_Tarih", "Gercek_Tarih", "NDVI", "Durum"]
+    cols = ["Parsel_#", *attr, "Alan_Dekar"]
+    for date in dates:
+        cols += list(dict.fromkeys(_ndvi_col(date, a) for a in ndvi_res.actuals_in(idx, date)))
+        cols.append(f"Durum_{date}")
+    return cols
+
+def _rows_part(feats, idx, ndvi_res, dates):
+    df=_base_frame(feats,idx)
+    v,a=ndvi_res.block(idx,dates); v=np.round(v,4)
+    for k,date in enumerate(dates):
+        names=np.array([_ndvi_col(date,x) for x in a[:,k]],dtype=object)
+        for name in pd.unique(names):
+            df[name]=np.where(names==name,v[:,k],np.nan)
+        df[f"Durum_{date}"]=ndvi_classes(v[:,k])
+    return df
+
+def _ts_part(feats, idx, ndvi_res, dates):
+    nd=len(dates); base=_base_frame(feats,idx)
+    df=base.loc[base.index.repeat(nd)].reset_index(drop=True)
+    v,a=ndvi_res.block(idx,dates)
+    tgt=np.tile(np.array(dates,dtype=object),len(idx)); a=a.ravel()
+    df["Hedef_Tarih"]=tgt
+    df["Gercek_Tarih"]=np.where(pd.isna(a)|(a==""),tgt,a)
+    df["NDVI"]=np.round(v.ravel(),4)
+    df["Durum"]=ndvi_classes(v.ravel())
+    return df
+
+def report_chunks(kind, feats, sel_ids, ndvi_res, dates, chunk=EXPORT_CHUNK):
+    """
+    (sütunlar, DataFrame parçaları üreteci). kind: "rows" (parsel bazlı) / "ts"
+    (zaman serisi, uzun format). Her parça ≤ chunk parsel, sabit şemaya oturtulur.
+    """
+    idx=feats.index(sel_ids); dates=sorted(dates)
+    cols=report_columns(kind,feats,idx,ndvi_res,dates)
+    part=_ts_part if kind=="ts" else _rows_part
+    def gen():
+        for k in range(0,len(idx),chunk):
+            yield part(feats,idx[k:k+chunk],ndvi_res,dates).reindex(columns=cols)
+    return cols, gen()
+
 def build_rows(feats, sel_ids, ndvi_res, dates):
-    fm={f["id"]:f for f in feats}; rows=[]
-    for fid in sel_ids:
-        feat=fm.get(fid)
-        if not feat: continue
-        rec={"Parsel_#":fid}
-        for k,v in feat["props"].items(): rec[str(k)]=v
-        rec["Alan_Dekar"]=area_dk(feat["geom"])
-        for date in sorted(dates):
-            nd=ndvi_res.get(fid,{}).get(date,{}); val=nd.get("ndvi"); act=nd.get("actual_date",date)
-            suffix=f"(ger:{act})" if act and act!=date else ""
-            rec[f"NDVI_{date}{suffix}"]=val
-            rec[f"Durum_{date}"]=("Ekili" if val is not None and val>0.35 else
-                                   "Geçiş" if val is not None and val>0.15 else
-                                   "Boş/Nadas" if val is not None else "")
-        rows.append(rec)
-    return rows
+    """Parsel başına bir satır (ekran tablosu)"""
+    cols,parts=report_chunks("rows",feats,sel_ids,ndvi_res,dates); parts=list(parts)
+    return pd.concat(parts,ignore_index=True) if parts else pd.DataFrame(columns=cols)
 
 def ts_rows(feats, sel_ids, ndvi_res, dates):
-    fm={f["id"]:f for f in feats}; rows=[]
-    for fid in sel_ids:
-        feat=fm.get(fid)
-        if not feat: continue
-        base={"Parsel_#":fid}
-        for k,v in feat["props"].items(): base[str(k)]=v
-        base["Alan_Dekar"]=area_dk(feat["geom"])
-        for date in sorted(dates):
-            nd=ndvi_res.get(fid,{}).get(date,{}); val=nd.get("ndvi"); act=nd.get("actual_date",date)
-            row=dict(base); row["Hedef_Tarih"]=date; row["Gercek_Tarih"]=act or date
-            row["NDVI"]=val
-            row["Durum"]=("Ekili" if val is not None and val>0.35 else
-                          "Geçiş" if val is not None and val>0.15 else
-                          "Boş/Nadas" if val is not None else "")
-            rows.append(row)
-    return rows
-
-def to_xlsx(rows, sheet="Analiz", hcol="1E5631"):
-    if not rows: return io.BytesIO()
-    df=pd.DataFrame(rows); buf=io.BytesIO()
-    with pd.ExcelWriter(buf,engine="openpyxl") as w:
-        df.to_excel(w,index=False,sheet_name=sheet)
-        ws=w.sheets[sheet]; hf=PatternFill("solid",fgColor=hcol)
-        for c in ws[1]:
-            c.fill=hf; c.font=Font(color="FFFFFF",bold=True)
-            c.alignment=Alignment(horizontal="center")
-        for col in ws.columns:
-            ws.column_dimensions[get_column_letter(col[0].column)].width=min(
-                max(len(str(c.value or "")) for c in col)+4,40)
-    buf.seek(0); return buf
+    """Uzun format: parsel × tarih başına bir satır"""
+    cols,parts=report_chunks("ts",feats,sel_ids,ndvi_res,dates); parts=list(parts)
+    return pd.concat(parts,ignore_index=True) if parts else pd.DataFrame(columns=cols)
 
-def to_csv(rows):
-    if not rows: return io.BytesIO()
+def _cells(df):
+    """NaN → None, numpy skalerleri → Python (openpyxl / csv için)"""
+    return df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+
+@timed("export.xlsx", size=lambda buf: buf.getbuffer().nbytes)
+def to_xlsx(cols, parts, sheet="Analiz", hcol="1E5631", sample=500):
+    """
+    Write-only openpyxl: satırlar parça parça akıtılır. Sütun genişlikleri
+    başlık + ilk parçanın ilk `sample` satırından hesaplanır.
+    """
+    wb=openpyxl.Workbook(write_only=True); ws=wb.create_sheet(sheet)
+    first=next(parts,None)
+    head=first.head(sample) if first is not None else pd.DataFrame(columns=cols)
+    for j,c in enumerate(cols,1):
+        w=head[c].astype(str).str.len().max() if len(head) else 0
+        ws.column_dimensions[get_column_letter(j)].width=min(max(len(str(c)),int(w or 0))+4,40)
+    hf=PatternFill("solid",fgColor=hcol); hfont=Font(color="FFFFFF",bold=True)
+    hal=Alignment(horizontal="center"); hdr=[]
+    for c in cols:
+        cell=WriteOnlyCell(ws,value=str(c)); cell.fill=hf; cell.font=hfont; cell.alignment=hal
+        hdr.append(cell)
+    ws.append(hdr)
+    if first is not None:
+        for part in chain([first],parts):
+            for row in _cells(part): ws.append(row)
+    buf=io.BytesIO(); wb.save(buf); buf.seek(0); return buf
+
+@timed("export.csv", size=lambda buf: buf.getbuffer().nbytes)
+def to_csv(cols, parts):
+    """UTF-8 BOM'lu CSV — başlık bir kez, sonra parça parça"""
     buf=io.BytesIO(); buf.write("\ufeff".encode("utf-8"))
-    buf.write(pd.DataFrame(rows).to_csv(index=False,float_format="%.4f").encode("utf-8"))
+    buf.write(pd.DataFrame(columns=cols).to_csv(index=False).encode("utf-8"))
+    for part in parts:
+        buf.write(part.to_csv(index=False,header=False,float_format="%.4f").encode("utf-8"))
+    buf.seek(0); return buf
+
+# pandas infer_dtype → Parquet tipi (tanınmayanlar metin)
+PARQUET_KINDS = {"integer": "int64", "floating": "float64", "mixed-integer-float": "float64",
+                 "decimal": "float64", "boolean": "bool"}
+
+@timed("export.parquet", size=lambda buf: buf.getbuffer().nbytes)
+def to_parquet(cols, parts, kinds=None):
+    """
+    Parquet (pyarrow) — şema verinin tipinden: kinds ({sütun: infer_dtype},
+    ör. AttrIndex.kinds — tüm katman üzerinden) öncelikli, diğer sütunlar ilk parçadan.
+    """
+    import pyarrow as pa, pyarrow.parquet as pq
+    first=next(parts,None)
+    kind={c:pd.api.types.infer_dtype(first[c],skipna=True) for c in cols} if first is not None else {}
+    kind.update({c:k for c,k in (kinds or {}).items() if c in kind})
+    typ={c:PARQUET_KINDS.get(kind.get(c),"string") for c in cols}
+    schema=pa.schema([(str(c),pa.type_for_alias(typ[c])) for c in cols])
+    buf=io.BytesIO()
+    with pq.ParquetWriter(buf,schema,compression="zstd") as w:
+        for part in ([] if first is None else chain([first],parts)):
+            for c in cols:
+                t=typ[c]
+                if t=="string": part[c]=[str(x) if _present(x) else None for x in part[c]]
+                elif t=="int64": part[c]=pd.to_numeric(part[c],errors="coerce").astype("Int64")
+                elif t=="float64": part[c]=pd.to_numeric(part[c],errors="coerce").astype(float)
+                else: part[c]=part[c].astype("boolean")
+            part.columns=[str(c) for c in part.columns]
+            w.write_table(pa.Table.from_pandas(part,schema=schema,preserve_index=False))
     buf.seek(0); return buf
 
 # ══════════════════════════════════════════════════════════════
-# SIDEBAR
+# ARAYÜZ — yalnızca `streamlit run app.py` ile; içe aktarınca (batch.py) çalışmaz
 # ══════════════════════════════════════════════════════════════
-with st.sidebar:
-    st.markdown("## 🌿 AgroSense")
-    st.markdown("**Sentinel-2 NDVI Parsel Analiz**")
-    st.markdown("---")
-
-    # DOSYA
-    st.markdown("### 📁 Dosya Yükle")
-    uf=st.file_uploader("SHP(zip) · KML · KMZ · GeoJSON",
-                        type=["zip","kml","kmz","geojson","json"],
-                        label_visibility="collapsed")
-    if uf:
-        try:
-            loaded=load_file(uf)
-            st.session_state.features=loaded
-            st.session_state.selected_ids=[]
-            st.session_state.ndvi_results={}
-            lons=[]; lats=[]
-            for f in loaded:
-                coords=f["geom"].get("coordinates",[])
-                ring=coords[0] if coords else []
-                for c in ring:
-                    if isinstance(c,(list,tuple)) and len(c)>=2:
-                        lons.append(c[0]); lats.append(c[1])
-            if lons:
-                st.session_state.map_center=[(min(lats)+max(lats))/2,(min(lons)+max(lons))/2]
-                st.session_state.map_zoom=13
-            st.success(f"✓ {len(loaded)} parsel yüklendi")
-        except Exception as e: st.error(f"Hata: {e}")
-
-    st.markdown("---")
-    feats=st.session_state.features
+def main():
+    # st.rerun() istisnası hata sayılmaz; kesilen çalıştırma da ölçülür
+    with stage("ui.rerun"): ui()
+
+def ui():
+    st.set_page_config(page_title="AgroSense NDVI", page_icon="🌿",
+                       layout="wide", initial_sidebar_state="expanded")
+    st.markdown(PAGE_CSS, unsafe_allow_html=True)
+    init_session()
+
+    # ══════════════════════════════════════════════════════════════
+    # SIDEBAR
+    # ══════════════════════════════════════════════════════════════
+    with st.sidebar:
+        st.markdown("## 🌿 AgroSense")
+        st.markdown("**Sentinel-2 NDVI Parsel Analiz**")
+        st.markdown("---")
 
-    if feats:
-        st.markdown("### ☑️ Parsel Seç")
-        c1,c2=st.columns(2)
-        with c1:
-            if st.button("✅ Tümünü Seç"):
-                st.session_state.selected_ids=[f["id"] for f in feats]
-                st.rerun()
-        with c2:
-            if st.button("🗑 Temizle"):
+        # DOSYA
+        st.markdown("### 📁 Dosya Yükle")
+        uf=st.file_uploader("SHP(zip) · KML · KMZ · GeoJSON",
+                            type=["zip","kml","kmz","geojson","json"],
+                            label_visibility="collapsed")
+        # Aynı dosya her rerun'da yeniden işlenmesin (depo yüklemede bir kez kurulur)
+        if uf and st.session_state.get("upload_key")!=(uf.name,uf.size,getattr(uf,"file_id",None)):
+            try:
+                with stage("ingest") as rec:
+                    store=ParcelStore.from_features(iter_file(uf))
+                    rec.update(items=len(store),bytes_in=uf.size)
+                st.session_state.features=store
+                st.session_state.upload_key=(uf.name,uf.size,getattr(uf,"file_id",None))
                 st.session_state.selected_ids=[]
-                st.rerun()
+                st.session_state.ndvi_results=NdviResults(store.ids); results_changed()
+                if len(store):
+                    b=store.total_bounds()
+                    st.session_state.map_center=[(b[1]+b[3])/2,(b[0]+b[2])/2]
+                    st.session_state.map_zoom=13
+                st.session_state.map_view=None
+                st.success(f"✓ {len(store)} parsel yüklendi")
+            except Exception as e: st.error(f"Hata: {e}")
+
+        st.markdown("---")
+        feats=st.session_state.features
+
+        if feats:
+            st.markdown("### ☑️ Parsel Seç")
+            c1,c2=st.columns(2)
+            with c1:
+                if st.button("✅ Tümünü Seç"):
+                    st.session_state.selected_ids=list(feats.ids)
+                    st.rerun()
+            with c2:
+                if st.button("🗑 Temizle"):
+                    st.session_state.selected_ids=[]
+                    st.rerun()
 
-        all_keys=list({k for f in feats for k in f["props"]})
-        str_keys=[k for k in all_keys
-                  if all(isinstance(f["props"].get(k),(str,type(None))) for f in feats)]
-        if str_keys:
-            fcol=st.selectbox("Filtre sütunu",["—"]+str_keys,key="fcol")
-            if fcol!="—":
-                uvals=sorted({str(f["props"].get(fcol,"")) for f in feats if f["props"].get(fcol)})
-                svals=st.multiselect("Değer seç",uvals,key="fvals")
-                if svals and st.button("Filtreyi Uygula"):
-                    st.session_state.selected_ids=[f["id"] for f in feats
-                                                   if str(f["props"].get(fcol,"")) in svals]
+            aidx=feats.aidx
+            # Çok yüksek kardinaliteli sütunlar (ad, kod...) filtre yerine aramayla bulunur
+            str_keys=[c for c in feats.str_keys if aidx.card[c]<=FILTER_MAX_CARD]
+            if str_keys:
+                fcol=st.selectbox("Filtre sütunu",["—"]+str_keys,key="fcol",
+                                  format_func=lambda c:c if c=="—" else f"{c} ({aidx.card[c]})")
+                if fcol!="—":
+                    svals=st.multiselect("Değer seç",aidx.values(fcol),key="fvals")
+                    if svals and st.button("Filtreyi Uygula"):
+                        st.session_state.selected_ids=[feats.ids[i] for i in aidx.select(fcol,svals)]
+                        st.rerun()
+
+            # Arama: seçenekler yalnızca eşleşenler + mevcut seçim (tüm id'ler widget'a gitmez)
+            lk=feats.attrs.columns[0] if len(feats.attrs.columns) else None
+            lbl=lambda fid:f"#{fid} {aidx.value(lk,feats.pos[fid])[:18] if lk else ''}"
+            q=st.text_input("🔎 Parsel ara (id / öznitelik)",key="psearch")
+            hits=aidx.search(q) if q else np.empty(0,dtype=np.int32)
+            if q:
+                st.caption(f"{len(hits)} eşleşme")
+                if len(hits) and st.button(f"➕ Eşleşenleri seçime ekle ({len(hits)})"):
+                    ex=set(st.session_state.selected_ids)
+                    st.session_state.selected_ids+=[feats.ids[i] for i in hits if feats.ids[i] not in ex]
+                    st.rerun()
+            cur=st.session_state.selected_ids
+            found=[feats.ids[i] for i in hits[:SEARCH_SHOW]]
+            if len(cur)<=MSEL_MAX:
+                # Manuel multiselect — default her zaman session_state'ten
+                sel=st.multiselect("Manuel seç",list(dict.fromkeys(cur+found)),format_func=lbl,
+                                   default=cur,key="msel")
+                # Sadece kullanıcı elle değiştirince güncelle
+                if set(sel) != set(cur):
+                    st.session_state.selected_ids=sel
+            elif found:
+                add=st.multiselect("Eşleşenlerden ekle",found,format_func=lbl,key="madd")
+                if add and st.button("➕ Ekle",key="madd_btn"):
+                    ex=set(cur); st.session_state.selected_ids+=[f for f in add if f not in ex]
                     st.rerun()
 
-        # Manuel multiselect — default her zaman session_state'ten
-        lk=all_keys[0] if all_keys else None
-        id_opts={f["id"]:f"#{f['id']} {str(f['props'].get(lk,''))[:18] if lk else ''}" for f in feats}
-        sel=st.multiselect("Manuel seç",list(id_opts),
-                           format_func=lambda x:id_opts[x],
-                           default=st.session_state.selected_ids,
-                           key="msel")
-        # Sadece kullanıcı elle değiştirince güncelle
-        if set(sel) != set(st.session_state.selected_ids):
-            st.session_state.selected_ids=sel
-
-        st.caption(f"Seçili: **{len(st.session_state.selected_ids)}** / {len(feats)}")
-
-    st.markdown("---")
-
-    # TARİHLER
-    st.markdown("### 📅 NDVI Tarihleri")
-    t1,t2=st.tabs(["Tek/Toplu","Aralık"])
-
-    with t1:
-        nd=st.date_input("Tarih",value=datetime.today(),key="di",label_visibility="collapsed")
-        if st.button("➕ Ekle"):
-            ds=nd.strftime("%Y-%m-%d")
-            if ds not in st.session_state.ndvi_dates:
-                st.session_state.ndvi_dates.append(ds)
-            else: st.warning("Zaten var")
-        bulk=st.text_input("Toplu (virgülle): 2024-06-01, 2024-07-15",
-                           key="bulk",label_visibility="collapsed",
-                           placeholder="2024-06-01, 2024-07-15, 2024-08-20")
-        if st.button("➕ Toplu Ekle") and bulk:
-            added=0
-            for ds in bulk.split(","):
-                ds=ds.strip()
-                try:
-                    datetime.strptime(ds,"%Y-%m-%d")
+            st.caption(f"Seçili: **{len(st.session_state.selected_ids)}** / {len(feats)}")
+
+        st.markdown("---")
+
+        # TARİHLER
+        st.markdown("### 📅 NDVI Tarihleri")
+        t1,t2=st.tabs(["Tek/Toplu","Aralık"])
+
+        with t1:
+            nd=st.date_input("Tarih",value=datetime.today(),key="di",label_visibility="collapsed")
+            if st.button("➕ Ekle"):
+                ds=nd.strftime("%Y-%m-%d")
+                if ds not in st.session_state.ndvi_dates:
+                    st.session_state.ndvi_dates.append(ds)
+                else: st.warning("Zaten var")
+            bulk=st.text_input("Toplu (virgülle): 2024-06-01, 2024-07-15",
+                               key="bulk",label_visibility="collapsed",
+                               placeholder="2024-06-01, 2024-07-15, 2024-08-20")
+            if st.button("➕ Toplu Ekle") and bulk:
+                added=0
+                for ds in bulk.split(","):
+                    ds=ds.strip()
+                    try:
+                        datetime.strptime(ds,"%Y-%m-%d")
+                        if ds not in st.session_state.ndvi_dates:
+                            st.session_state.ndvi_dates.append(ds); added+=1
+                    except: pass
+                if added: st.success(f"✓ {added} tarih eklendi")
+
+        with t2:
+            ca,cb=st.columns(2)
+            with ca: rs=st.date_input("Başlangıç",value=datetime.today()-timedelta(days=90),key="rs",label_visibility="collapsed")
+            with cb: rend=st.date_input("Bitiş",value=datetime.today(),key="re",label_visibility="collapsed")
+            iv=st.selectbox("Aralık (gün)",[5,10,15,30],index=2,key="iv")
+            if st.button("➕ Aralık Ekle"):
+                cur=rs; added=0
+                while cur<=rend:
+                    ds=cur.strftime("%Y-%m-%d")
                     if ds not in st.session_state.ndvi_dates:
                         st.session_state.ndvi_dates.append(ds); added+=1
-                except: pass
-            if added: st.success(f"✓ {added} tarih eklendi")
-
-    with t2:
-        ca,cb=st.columns(2)
-        with ca: rs=st.date_input("Başlangıç",value=datetime.today()-timedelta(days=90),key="rs",label_visibility="collapsed")
-        with cb: re=st.date_input("Bitiş",value=datetime.today(),key="re",label_visibility="collapsed")
-        iv=st.selectbox("Aralık (gün)",[5,10,15,30],index=2,key="iv")
-        if st.button("➕ Aralık Ekle"):
-            cur=rs; added=0
-            while cur<=re:
-                ds=cur.strftime("%Y-%m-%d")
-                if ds not in st.session_state.ndvi_dates:
-                    st.session_state.ndvi_dates.append(ds); added+=1
-                cur+=timedelta(days=iv)
-            st.success(f"✓ {added} tarih eklendi")
-
-    if st.session_state.ndvi_dates:
-        for dstr in list(st.session_state.ndvi_dates):
-            r1,r2=st.columns([4,1])
-            with r1:
-                w=st.session_state.date_warnings.get(dstr)
-                st.markdown(f"📅 {dstr}"+(f" → `{w}`" if w and w!=dstr else ""))
-            with r2:
-                if st.button("✕",key=f"rm_{dstr}"):
-                    st.session_state.ndvi_dates.remove(dstr); st.rerun()
-        if st.button("🗑 Tümünü Temizle"):
-            st.session_state.ndvi_dates=[]; st.rerun()
-        st.session_state.active_date=st.selectbox(
-            "Aktif tarih (harita)",st.session_state.ndvi_dates,key="adsel")
-
-    st.markdown("---")
-
-    # ANALİZ
-    st.markdown("### 🔬 NDVI Analiz")
-    if st.button("◉ Analiz Başlat",type="primary"):
-        sel=st.session_state.selected_ids
-        dates=st.session_state.ndvi_dates
-        if not sel: st.error("Önce parsel seçin")
-        elif not dates: st.error("Önce tarih ekleyin")
-        else:
-            fm={f["id"]:f for f in st.session_state.features}
-            sel_feats=[fm[fid] for fid in sel if fid in fm]
-            # Hesaplanmamış tarih-parsel çiftleri
-            to_do=[]
-            for date in dates:
-                missing=[f for f in sel_feats
-                         if date not in st.session_state.ndvi_results.get(f["id"],{})]
-                if missing: to_do.append((date,missing))
-
-            if not to_do:
-                st.info("Tüm değerler zaten hesaplanmış.")
+                    cur+=timedelta(days=iv)
+                st.success(f"✓ {added} tarih eklendi")
+
+        if st.session_state.ndvi_dates:
+            for dstr in list(st.session_state.ndvi_dates):
+                r1,r2=st.columns([4,1])
+                with r1:
+                    w=st.session_state.date_warnings.get(dstr)
+                    st.markdown(f"📅 {dstr}"+(f" → `{w}`" if w and w!=dstr else ""))
+                with r2:
+                    if st.button("✕",key=f"rm_{dstr}"):
+                        st.session_state.ndvi_dates.remove(dstr); st.rerun()
+            if st.button("🗑 Tümünü Temizle"):
+                st.session_state.ndvi_dates=[]; st.rerun()
+            st.session_state.active_date=st.selectbox(
+                "Aktif tarih (harita)",st.session_state.ndvi_dates,key="adsel")
+
+        st.markdown("---")
+
+        # ANALİZ
+        st.markdown("### 🔬 NDVI Analiz")
+        backend=st.radio("Hesap motoru",list(NDVI_BACKENDS),horizontal=True,key="backend",
+                         format_func=lambda b:NDVI_BACKENDS[b]["label"])
+        if backend=="local":
+            st.caption(f"`{LOCAL_RASTER_DIR}` → {len(local_catalog())} tarih")
+        if backend=="cube":
+            st.caption(f"`{CUBE_DIR}` → {len(_cube_index())} küp")
+        reducer=st.selectbox("Parsel istatistiği",NDVI_BACKENDS[backend]["reducers"],key="reducer")
+        series=st.checkbox("⏱ Zaman serisi modu (tek execute)",value=True,key="ts_mode",
+                           help="Tüm sahne günleri tek OpenEO process graph ile hesaplanır")
+        workers=st.slider("Paralel OpenEO işi",1,8,OPENEO_WORKERS,key="oeo_workers")
+        if st.button("🗑 NDVI önbelleğini temizle"):
+            if get_ndvi_cache(): get_ndvi_cache().clear()
+            ndvi_mem_cache().clear(); scene_cache().clear()
+            st.success("✓ Önbellek temizlendi")
+        if st.button("◉ Analiz Başlat",type="primary"):
+            sel=st.session_state.selected_ids
+            dates=st.session_state.ndvi_dates
+            if not sel: st.error("Önce parsel seçin")
+            elif not dates: st.error("Önce tarih ekleyin")
             else:
-                prog=st.progress(0,text="⏳ STAC → en yakın tarih bulunuyor...")
-                errors=[]
-                for i,(date,missing) in enumerate(to_do):
-                    prog.progress(i/len(to_do),
-                                  text=f"📡 {date} — {len(missing)} parsel batch...")
+                # Motor / istatistik değişince eski sonuçlar karışmasın
+                if st.session_state.get("ndvi_method")!=(backend,reducer):
+                    st.session_state.ndvi_results=NdviResults(st.session_state.features.ids); results_changed()
+                    st.session_state.ndvi_method=(backend,reducer)
+                store=st.session_state.features
+                sidx=store.index(sel)
+                # Hesaplanmamış tarih-parsel çiftleri (store konumları)
+                to_do=[]
+                for date in dates:
+                    missing=sidx[~st.session_state.ndvi_results.done(sidx,date)]
+                    if len(missing): to_do.append((date,missing))
+
+                if not to_do:
+                    st.info("Tüm değerler zaten hesaplanmış.")
+                else:
+                    prog=st.progress(0,text="⏳ STAC → en yakın tarih bulunuyor...")
+                    errors={}; res=st.session_state.ndvi_results
+                    total=sum(len(m) for _,m in to_do); done=0; touched=set(); raw=[]
                     try:
-                        vals, actual = fetch_ndvi_batch(missing, date)
-                        if actual is None:
-                            for f in missing:
-                                if f["id"] not in st.session_state.ndvi_results:
-                                    st.session_state.ndvi_results[f["id"]]={}
-                                st.session_state.ndvi_results[f["id"]][date]={
-                                    "ndvi":None,"actual_date":date}
-                            errors.append(f"{date}: ±15 gün içinde görüntü yok")
-                            continue
-                        if actual != date:
-                            st.session_state.date_warnings[date]=actual
-                        for fid,val in vals.items():
-                            if fid not in st.session_state.ndvi_results:
-                                st.session_state.ndvi_results[fid]={}
-                            st.session_state.ndvi_results[fid][date]={
-                                "ndvi":val,"actual_date":actual}
+                        with stage("analysis",total):
+                            for date,vals,actual,err in run_analysis(store,to_do,series,workers,
+                                                                     backend,reducer,raw):
+                                if err: errors.setdefault(f"{date}: {err}",None)
+                                elif actual != date:
+                                    st.session_state.date_warnings[date]=actual
+                                res.put(date,vals,actual)
+                                if vals: touched.add(date)
+                                done+=len(vals)
+                                prog.progress(min(done/total,1.0),
+                                              text=f"📡 {date} ✓ — {done}/{total} parsel·tarih")
                     except Exception as e:
-                        errors.append(f"{date}: {str(e)[:120]}")
-                        for f in missing:
-                            if f["id"] not in st.session_state.ndvi_results:
-                                st.session_state.ndvi_results[f["id"]]={}
-                            st.session_state.ndvi_results[f["id"]][date]={
-                                "ndvi":None,"actual_date":date}
-
-                prog.progress(1.0,text="✓ Tamamlandı!")
-                time.sleep(0.3); prog.empty()
-
-                if errors:
-                    for e in errors: st.warning(e)
-                else:
-                    st.success(f"✓ {len(sel)} parsel × {len(dates)} tarih!")
-
-                # Debug: son raw yanıt
-                if "_last_raw" in st.session_state:
-                    with st.expander("🔍 Debug: son API yanıtı"):
-                        st.code(st.session_state["_last_raw"])
+                        # gelen sonuçlar korunur; kalan tarih-parsel çiftleri sonraki çalıştırmada
+                        errors.setdefault(f"Analiz yarıda kaldı: {str(e)[:120]}",None)
+                    results_changed(touched)
+                    if raw: st.session_state["_last_raw"]=raw[-1]
+
+                    prog.progress(1.0,text="✓ Tamamlandı!")
+                    time.sleep(0.3); prog.empty()
+
+                    if errors:
+                        for e in errors: st.warning(e)
+                    else:
+                        st.success(f"✓ {len(sel)} parsel × {len(dates)} tarih!")
+                    st.rerun()
 
-                st.rerun()
+        st.markdown("---")
 
-    st.markdown("---")
-
-    # EXPORT
-    st.markdown("### 💾 Dışa Aktar")
-    if st.session_state.selected_ids and st.session_state.ndvi_dates:
-        etype=st.radio("Tür",["Parsel bazlı","Zaman serisi"],horizontal=True,key="etype")
-        fmt=st.radio("Format",["xlsx","csv","ikisi de"],horizontal=True,key="efmt")
-        if st.button("⬇️ İndir"):
-            fa=st.session_state.features; sa=st.session_state.selected_ids
-            na=st.session_state.ndvi_results; da=st.session_state.ndvi_dates
-            fn=f"agrosense_{datetime.today().strftime('%Y%m%d_%H%M')}"
-            if etype=="Parsel bazlı":
-                rows=build_rows(fa,sa,na,da)
-                if fmt in("xlsx","ikisi de"):
-                    st.download_button("📊 Excel (Parsel)",data=to_xlsx(rows),
-                        file_name=f"{fn}_parsel.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-                if fmt in("csv","ikisi de"):
-                    st.download_button("📄 CSV (Parsel)",data=to_csv(rows),
-                        file_name=f"{fn}_parsel.csv",mime="text/csv")
-            else:
-                rows=ts_rows(fa,sa,na,da)
+        # EXPORT
+        st.markdown("### 💾 Dışa Aktar")
+        if st.session_state.selected_ids and st.session_state.ndvi_dates:
+            etype=st.radio("Tür",["Parsel bazlı","Zaman serisi"],horizontal=True,key="etype")
+            fmt=st.radio("Format",["xlsx","csv","parquet","ikisi de"],horizontal=True,key="efmt")
+            if st.button("⬇️ İndir"):
+                fa=st.session_state.features; sa=st.session_state.selected_ids
+                na=st.session_state.ndvi_results; da=st.session_state.ndvi_dates
+                fn=f"agrosense_{datetime.today().strftime('%Y%m%d_%H%M')}"
+                kind,tag=("rows","parsel") if etype=="Parsel bazlı" else ("ts","zaman_serisi")
+                sheet,hcol=REPORT_SHEETS[kind]
+                name="Parsel" if kind=="rows" else "Zaman Serisi"
+                # Her format kendi parça akışını alır — rapor bellekte tek parça halinde kurulmaz
                 if fmt in("xlsx","ikisi de"):
-                    st.download_button("📊 Excel (Zaman Serisi)",
-                        data=to_xlsx(rows,"Zaman_Serisi","1A3A6A"),
-                        file_name=f"{fn}_zaman_serisi.xlsx",
+                    st.download_button(f"📊 Excel ({name})",
+                        data=to_xlsx(*report_chunks(kind,fa,sa,na,da),sheet,hcol),
+                        file_name=f"{fn}_{tag}.xlsx",
                         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
                 if fmt in("csv","ikisi de"):
-                    st.download_button("📄 CSV (Zaman Serisi)",data=to_csv(rows),
-                        file_name=f"{fn}_zaman_serisi.csv",mime="text/csv")
-    else: st.caption("Parsel seçin ve tarih ekleyin")
+                    st.download_button(f"📄 CSV ({name})",data=to_csv(*report_chunks(kind,fa,sa,na,da)),
+                        file_name=f"{fn}_{tag}.csv",mime="text/csv")
+                if fmt=="parquet":
+                    try:
+                        st.download_button(f"🧱 Parquet ({name})",
+                            data=to_parquet(*report_chunks(kind,fa,sa,na,da),fa.aidx.kinds),
+                            file_name=f"{fn}_{tag}.parquet",mime="application/octet-stream")
+                    except ImportError: st.error("Parquet için pyarrow gerekli")
+        else: st.caption("Parsel seçin ve tarih ekleyin")
 
-# ══════════════════════════════════════════════════════════════
-# ANA ALAN
-# ══════════════════════════════════════════════════════════════
-st.markdown("# 🌿 AgroSense — Sentinel-2 NDVI")
-
-feats=st.session_state.features
-sel_ids=st.session_state.selected_ids
-ndvi_res=st.session_state.ndvi_results
-act_date=st.session_state.active_date
-
-# Metrikler
-if sel_ids and act_date:
-    vals=[ndvi_res.get(fid,{}).get(act_date,{}).get("ndvi") for fid in sel_ids
-          if ndvi_res.get(fid,{}).get(act_date,{}).get("ndvi") is not None]
-    avg=round(sum(vals)/len(vals),3) if vals else None
-    c1,c2,c3,c4=st.columns(4)
-    c1.markdown(f'<div class="mcard"><div class="mval">{len(sel_ids)}</div><div class="mlbl">Seçili</div></div>',unsafe_allow_html=True)
-    c2.markdown(f'<div class="mcard"><div class="mval" style="color:{ndvi_color(avg)}">{avg or "—"}</div><div class="mlbl">Ort. NDVI</div></div>',unsafe_allow_html=True)
-    c3.markdown(f'<div class="mcard"><div class="mval" style="color:#1a9850">{sum(1 for v in vals if v>0.35)}</div><div class="mlbl">🌾 Ekili</div></div>',unsafe_allow_html=True)
-    c4.markdown(f'<div class="mcard"><div class="mval" style="color:#d73027">{sum(1 for v in vals if v<=0.15)}</div><div class="mlbl">🌱 Boş/Nadas</div></div>',unsafe_allow_html=True)
-    warn=st.session_state.date_warnings.get(act_date)
-    if warn and warn!=act_date:
-        st.markdown(f'<div class="dwarn">📅 <b>{act_date}</b> için görüntü yok — en yakın: <b>{warn}</b> kullanıldı (±15 gün)</div>',unsafe_allow_html=True)
-
-# Harita
-sent_date=act_date or (st.session_state.ndvi_dates[-1] if st.session_state.ndvi_dates else None)
-m=build_map(feats,sel_ids,act_date,ndvi_res,sent_date)
-map_out=st_folium(m,width="100%",height=550,returned_objects=["all_drawings"])
-
-# Alan çizerek seçim
-drawings=map_out.get("all_drawings") or []
-if len(drawings)!=st.session_state.last_draw_count and drawings and feats:
-    st.session_state.last_draw_count=len(drawings)
-    dg=drawings[-1].get("geometry")
-    if dg:
-        try:
-            ds=shape(dg)
-            matched=[f["id"] for f in feats
-                     if ds.contains(shape(f["geom"]).centroid) or ds.intersects(shape(f["geom"]))]
-            if matched:
-                ex=set(st.session_state.selected_ids); ex.update(matched)
-                st.session_state.selected_ids=list(ex)
-                st.success(f"✓ **{len(matched)}** parsel seçildi (toplam: {len(st.session_state.selected_ids)})")
+    # ══════════════════════════════════════════════════════════════
+    # ANA ALAN
+    # ══════════════════════════════════════════════════════════════
+    st.markdown("# 🌿 AgroSense — Sentinel-2 NDVI")
+
+    feats=st.session_state.features
+    sel_ids=st.session_state.selected_ids
+    ndvi_res=st.session_state.ndvi_results
+    act_date=st.session_state.active_date
+
+    # Metrikler
+    if sel_ids and act_date:
+        vals=ndvi_res.column(act_date,feats.index(sel_ids)); vals=vals[~np.isnan(vals)]
+        avg=round(float(vals.mean()),3) if len(vals) else None
+        c1,c2,c3,c4=st.columns(4)
+        c1.markdown(f'<div class="mcard"><div class="mval">{len(sel_ids)}</div><div class="mlbl">Seçili</div></div>',unsafe_allow_html=True)
+        c2.markdown(f'<div class="mcard"><div class="mval" style="color:{ndvi_color(avg)}">{avg or "—"}</div><div class="mlbl">Ort. NDVI</div></div>',unsafe_allow_html=True)
+        c3.markdown(f'<div class="mcard"><div class="mval" style="color:#1a9850">{int((vals>0.35).sum())}</div><div class="mlbl">🌾 Ekili</div></div>',unsafe_allow_html=True)
+        c4.markdown(f'<div class="mcard"><div class="mval" style="color:#d73027">{int((vals<=0.15).sum())}</div><div class="mlbl">🌱 Boş/Nadas</div></div>',unsafe_allow_html=True)
+        warn=st.session_state.date_warnings.get(act_date)
+        if warn and warn!=act_date:
+            st.markdown(f'<div class="dwarn">📅 <b>{act_date}</b> için görüntü yok — en yakın: <b>{warn}</b> kullanıldı (±15 gün)</div>',unsafe_allow_html=True)
+
+    # Harita
+    sent_date=act_date or (st.session_state.ndvi_dates[-1] if st.session_state.ndvi_dates else None)
+    m=build_map(sent_date)
+    fp=feats.fingerprint if feats else None; sel_fp=sel_fingerprint(sel_ids)
+    fg,view_note=memo("layer",(fp,sel_fp,act_date,results_key([act_date] if act_date else []),
+                               st.session_state.map_view),
+                      lambda:parcel_layer(feats,sel_ids,act_date,ndvi_res,st.session_state.map_view))
+    # Parseller feature_group_to_add ile gider: kaydırmada taban harita yeniden kurulmaz
+    with stage("map.render"):
+        map_out=st_folium(m,key="map",width="100%",height=550,feature_group_to_add=fg,
+                          center=st.session_state.map_center,zoom=st.session_state.map_zoom,
+                          returned_objects=["all_drawings","bounds","zoom","center"])
+    if view_note: st.caption(view_note)
+
+    # Görünüm katman kutusundan çıktı / zoom değişti → katmanı yeni kutuyla yeniden kur;
+    # kutu içindeki kaydırmada yalnızca merkez/zoom saklanır (yeniden çalıştırma yok)
+    mb,mz=map_out.get("bounds") or {},map_out.get("zoom")
+    if mz and mb.get("_southWest") and mb.get("_northEast"):
+        sw,ne=mb["_southWest"],mb["_northEast"]
+        if None not in (sw.get("lng"),sw.get("lat"),ne.get("lng"),ne.get("lat")):
+            view=(sw["lng"],sw["lat"],ne["lng"],ne["lat"],mz)
+            c=map_out.get("center") or {}
+            if c.get("lat") is not None:
+                st.session_state.map_center=[c["lat"],c["lng"]]
+            st.session_state.map_zoom=mz
+            if not view_inside(view,st.session_state.map_view):
+                st.session_state.map_view=layer_view(view)
                 st.rerun()
-            else: st.info("Çizilen alanda parsel yok")
-        except Exception as e: st.warning(f"Seçim hatası: {e}")
-
-# Zaman serisi grafik
-if sel_ids and len(st.session_state.ndvi_dates)>1:
-    has=any(ndvi_res.get(fid,{}).get(d,{}).get("ndvi") is not None
-            for fid in sel_ids for d in st.session_state.ndvi_dates)
-    if has:
+
+    # Alan çizerek seçim
+    drawings=map_out.get("all_drawings") or []
+    if len(drawings)!=st.session_state.last_draw_count and drawings and feats:
+        st.session_state.last_draw_count=len(drawings)
+        dg=drawings[-1].get("geometry")
+        if dg:
+            try:
+                ds=shape(dg)
+                matched=feats.match(ds)
+                if matched:
+                    ex=set(st.session_state.selected_ids); ex.update(matched)
+                    st.session_state.selected_ids=list(ex)
+                    st.success(f"✓ **{len(matched)}** parsel seçildi (toplam: {len(st.session_state.selected_ids)})")
+                    st.rerun()
+                else: st.info("Çizilen alanda parsel yok")
+            except Exception as e: st.warning(f"Seçim hatası: {e}")
+
+    # Zaman serisi grafik
+    dkey=tuple(sorted(st.session_state.ndvi_dates)); rkey=(fp,sel_fp,dkey,results_key(dkey))
+    def _ts_frame():
+        idx=feats.index(sel_ids); v,_=ndvi_res.block(idx,dkey)
+        keep=~np.isnan(v).all(axis=1)
+        if not keep.any(): return None
+        return pd.DataFrame(v[keep].T,index=pd.to_datetime(list(dkey)),
+                            columns=[feats.label(i) for i in idx[keep]])
+    if sel_ids and len(dkey)>1:
+        df_ts=memo("ts",rkey,_ts_frame)
+        if df_ts is not None:
+            st.markdown("---")
+            st.markdown("### 📈 Zaman Serisi")
+            st.line_chart(df_ts)
+
+    # Tablo
+    if sel_ids and dkey:
         st.markdown("---")
-        st.markdown("### 📈 Zaman Serisi")
-        fm={f["id"]:f for f in feats}; ts={}
-        for fid in sel_ids:
-            feat=fm.get(fid); lbl=f"#{fid}"
-            if feat and feat["props"]:
-                k0=list(feat["props"].keys())[0]
-                lbl=f"#{fid} {str(feat['props'][k0])[:15]}"
-            s={d:ndvi_res.get(fid,{}).get(d,{}).get("ndvi")
-               for d in sorted(st.session_state.ndvi_dates)
-               if ndvi_res.get(fid,{}).get(d,{}).get("ndvi") is not None}
-            if s: ts[lbl]=s
-        if ts:
-            df_ts=pd.DataFrame(ts).T
-            df_ts.columns=pd.to_datetime(df_ts.columns)
-            st.line_chart(df_ts.T)
-
-# Tablo
-if sel_ids and st.session_state.ndvi_dates:
-    st.markdown("---")
-    st.markdown("### 📋 Sonuçlar")
-    rows=build_rows(feats,sel_ids,ndvi_res,st.session_state.ndvi_dates)
-    if rows: st.dataframe(pd.DataFrame(rows),use_container_width=True,hide_index=True)
-
-with st.expander("🎨 NDVI Renk Skalası"):
-    items=[("#5ab4d6","<0","Su"),("#d73027","0-0.10","Çıplak"),("#f46d43","0.10-0.20","Düşük"),
-           ("#fdae61","0.20-0.25","Düşük+"),("#fee08b","0.25-0.35","Orta"),("#d9ef8b","0.35-0.45","İyi"),
-           ("#a6d96a","0.45-0.55","İyi+"),("#66bd63","0.55-0.65","Yüksek"),("#1a9850",">0.65","Çok Yüksek")]
-    cols=st.columns(9)
-    for col,(color,rng,lbl) in zip(cols,items):
-        tc="#fff" if color not in("#fee08b","#d9ef8b","#a6d96a") else "#222"
-        col.markdown(f'<div style="background:{color};border-radius:6px;padding:8px;text-align:center;color:{tc}"><div style="font-size:10px;font-weight:700">{lbl}</div><div style="font-size:9px">{rng}</div></div>',unsafe_allow_html=True)
+        st.markdown("### 📋 Sonuçlar")
+        df_rows=memo("table",rkey,lambda:build_rows(feats,sel_ids,ndvi_res,dkey))
+        if len(df_rows): st.dataframe(df_rows,use_container_width=True,hide_index=True)
+
+    with st.expander("🎨 NDVI Renk Skalası"):
+        items=[("#5ab4d6","<0","Su"),("#d73027","0-0.10","Çıplak"),("#f46d43","0.10-0.20","Düşük"),
+               ("#fdae61","0.20-0.25","Düşük+"),("#fee08b","0.25-0.35","Orta"),("#d9ef8b","0.35-0.45","İyi"),
+               ("#a6d96a","0.45-0.55","İyi+"),("#66bd63","0.55-0.65","Yüksek"),("#1a9850",">0.65","Çok Yüksek")]
+        cols=st.columns(9)
+        for col,(color,rng,lbl) in zip(cols,items):
+            tc="#fff" if color not in("#fee08b","#d9ef8b","#a6d96a") else "#222"
+            col.markdown(f'<div style="background:{color};border-radius:6px;padding:8px;text-align:center;color:{tc}"><div style="font-size:10px;font-weight:700">{lbl}</div><div style="font-size:9px">{rng}</div></div>',unsafe_allow_html=True)
+
+    # Tanılama: aşama süreleri, bayt, önbellek isabeti (süreç geneli, son sıfırlamadan beri)
+    with st.expander("🩺 Tanılama"):
+        snap=metrics_snapshot()
+        st.caption(f"{snap['since']} itibarıyla · {snap['uptime_s']:.0f} s · bu çalıştırma hariç")
+        if snap["stages"]:
+            st.dataframe(pd.DataFrame([{
+                "Aşama":k,"Çağrı":v["calls"],"Hata":v["errors"],"Toplam s":round(v["secs"],3),
+                "Ort. ms":round(v["secs"]/v["calls"]*1000,1),"En uzun ms":round(v["max_secs"]*1000,1),
+                "Sunucu bekleme s":round(v["wait_secs"],3),"Gönderilen kB":round(v["bytes_out"]/1024,1),
+                "Alınan kB":round(v["bytes_in"]/1024,1),"Parsel":v["items"]}
+                for k,v in snap["stages"].items()]),use_container_width=True,hide_index=True)
+        if snap["caches"]:
+            st.dataframe(pd.DataFrame([{"Önbellek":k,"İsabet":v["hits"],"Iska":v["misses"],
+                "Oran":f"{v['ratio']:.0%}" if v["ratio"] is not None else "—"}
+                for k,v in snap["caches"].items()]),use_container_width=True,hide_index=True)
+        c1,c2,c3=st.columns(3)
+        c1.download_button("⬇️ JSON",json.dumps(snap,ensure_ascii=False,indent=1),
+                           file_name="agrosense_metrics.json",mime="application/json")
+        c2.download_button("⬇️ Prometheus",prometheus_text(snap),
+                           file_name="agrosense_metrics.prom",mime="text/plain")
+        if c3.button("↺ Sıfırla"): metrics_reset(); st.rerun()
+        if "_last_raw" in st.session_state:
+            st.caption("Son OpenEO yanıtı (ilk 500 karakter)")
+            st.code(st.session_state["_last_raw"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+AgroSense — başsız (Streamlit'siz) toplu NDVI çalıştırıcı
+- Arayüzle aynı boru hattı: iter_file → run_analysis → report_chunks → to_xlsx/csv/parquet
+- Parsel seti mekânsal olarak yakın parçalara (shard) bölünür, parçalar ayrı süreçlerde çalışır
+- Biten her parça checkpoint klasörüne yazılır; kesilen iş aynı komutla kaldığı yerden sürer
+
+Örnek:
+    python batch.py parseller.zip -d 2024-06-01,2024-07-15 -o rapor.xlsx
+    python batch.py parseller.kml -d 2024-03-01:2024-09-01:15 -o seri.parquet --kind ts -p 4
+"""
+import argparse, json, os, sys, time, hashlib, logging
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+import app   # boru hattı; arayüz yalnızca `streamlit run app.py` ile kurulur
+
+SHARD_SIZE = 2000    # parça başına parsel
+SHARD_BAND = 0.05    # mekânsal sıralama için enlem bandı (derece)
+WRITERS    = {".xlsx": "to_xlsx", ".csv": "to_csv", ".parquet": "to_parquet"}
+
+
+def _log(msg):
+    print(f"[{datetime.now():%H:%M:%S}] {msg}", file=sys.stderr, flush=True)
+
+# ── Girdi ─────────────────────────────────────────────────────
+def load_parcels(path):
+    """Dosya yolu → ParcelStore (arayüzdeki yükleme ile aynı okuyucular)"""
+    with open(path, "rb") as fh:
+        return app.ParcelStore.from_features(app.iter_file(fh))
+
+def parse_dates(spec):
+    """
+    "2024-06-01,2024-07-15"  → liste
+    "2024-03-01:2024-09-01:15" → aralık (başlangıç:bitiş:gün, arayüzdeki "Aralık Ekle" gibi)
+    "@tarihler.txt"          → satır/virgül ayraçlı dosya
+    """
+    if spec.startswith("@"):
+        with open(spec[1:], encoding="utf-8") as fh: spec = fh.read().replace("\n", ",")
+    out = []
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        if part.count(":") == 2:
+            a, b, step = part.split(":")
+            cur, end = datetime.strptime(a, "%Y-%m-%d"), datetime.strptime(b, "%Y-%m-%d")
+            while cur <= end:
+                out.append(cur.strftime("%Y-%m-%d")); cur += timedelta(days=int(step))
+        else:
+            out.append(datetime.strptime(part, "%Y-%m-%d").strftime("%Y-%m-%d"))
+    return sorted(set(out))
+
+def select_ids(store, where=()):
+    """--where SÜTUN=D1,D2 koşulları (AND) → parsel id'leri; koşul yoksa hepsi"""
+    mask = np.ones(len(store), bool)
+    for cond in where:
+        col, _, vals = cond.partition("=")
+        if col not in store.aidx.cols: raise ValueError(f"Sütun yok: {col}")
+        mask &= store.aidx.mask(col, [v.strip() for v in vals.split(",")])
+    return [store.ids[i] for i in np.flatnonzero(mask)]
+
+def make_shards(store, ids, size=SHARD_SIZE):
+    """Merkezlere göre enlem bandı + boylam sırası — parçalar mekânsal olarak derli toplu"""
+    idx = store.index(ids)
+    xy = store.cxy[idx]
+    order = idx[np.lexsort((xy[:, 0], np.floor(xy[:, 1] / SHARD_BAND)))]
+    return [[store.ids[i] for i in order[k:k + size]] for k in range(0, len(order), size)]
+
+# ── Checkpoint ────────────────────────────────────────────────
+def _write_json(path, obj):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fh: json.dump(obj, fh, ensure_ascii=False)
+    os.replace(tmp, path)   # yarım yazılmış checkpoint kalmaz
+
+def _read_json(path):
+    with open(path, encoding="utf-8") as fh: return json.load(fh)
+
+def _shard_path(ckpt, k): return os.path.join(ckpt, f"shard_{k:05d}.json")
+
+def job_key(store, shards, dates, backend, reducer, series):
+    """İş tanımı özeti — checkpoint yalnızca aynı işe devam ederken kullanılır"""
+    h = hashlib.sha1(json.dumps([store.fingerprint, dates, backend, reducer, series],
+                                sort_keys=True).encode())
+    for sh in shards: h.update("\0".join(sh).encode()); h.update(b"\1")
+    return h.hexdigest()
+
+# ── Parça işçisi (ayrı süreç) ─────────────────────────────────
+def _quiet():
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+def run_shard(k, ids, geoms, dates, backend, reducer, series, workers, path):
+    """
+    Tek parça: run_analysis ile tüm tarihler, sonuç checkpoint'e yazılır.
+    Parça kendi (özniteliksiz) ParcelStore'unu kurar — geometri özetleri aynı kalır.
+    Returns: (k, satır sayısı, hatalar, süre)
+    """
+    t0 = time.time(); rows = []; errors = {}
+    store = app.ParcelStore(ids, geoms, pd.DataFrame(index=range(len(ids))))
+    idx = np.arange(len(store))
+    for date, vals, actual, err in app.run_analysis(store, [(d, idx) for d in dates],
+                                                     series, workers, backend, reducer):
+        if err: errors.setdefault(f"{date}: {err}", None)
+        rows += [[fid, date, val, actual] for fid, val in vals.items()]
+    _write_json(path, {"shard": k, "n": len(ids), "rows": rows,
+                       "errors": list(errors), "secs": round(time.time() - t0, 1)})
+    return k, len(rows), list(errors), time.time() - t0
+
+# ── Ana akış ──────────────────────────────────────────────────
+def run_batch(parcels, dates, out, kind="rows", backend="openeo", reducer="mean",
+              series=True, processes=1, workers=app.OPENEO_WORKERS, shard_size=SHARD_SIZE,
+              checkpoint=None, where=(), retry_errors=False, fresh=False):
+    """
+    Kütüphane giriş noktası. parcels: dosya yolu veya ParcelStore.
+    Geçersiz girdi (çıktı türü, istatistik, boş seçim, yabancı checkpoint) → ValueError.
+    Returns: {"out", "shards", "ran", "errors"}
+    """
+    ext = os.path.splitext(out)[1].lower()
+    if ext not in WRITERS: raise ValueError(f"Desteklenmeyen çıktı: {ext} ({', '.join(WRITERS)})")
+    if reducer not in app.NDVI_BACKENDS[backend]["reducers"]:
+        raise ValueError(f"{backend} motoru '{reducer}' istatistiğini desteklemiyor")
+    store = parcels if isinstance(parcels, app.ParcelStore) else load_parcels(parcels)
+    ids = select_ids(store, where)
+    if not ids: raise ValueError("Seçilen parsel yok")
+    if not dates: raise ValueError("Tarih yok")
+    shards = make_shards(store, ids, shard_size)
+    _log(f"{len(ids)} parsel × {len(dates)} tarih → {len(shards)} parça")
+
+    ckpt = checkpoint or f"{out}.ckpt"
+    os.makedirs(ckpt, exist_ok=True)
+    key = job_key(store, shards, dates, backend, reducer, series)
+    man = os.path.join(ckpt, "manifest.json")
+    if os.path.exists(man) and _read_json(man).get("key") != key:
+        if not fresh:
+            raise ValueError(f"{ckpt} başka bir işe ait — --fresh ile sıfırlayın veya başka klasör verin")
+        for n in os.listdir(ckpt):
+            if n.startswith("shard_"): os.remove(os.path.join(ckpt, n))
+    _write_json(man, {"key": key, "shards": len(shards), "dates": dates,
+                      "backend": backend, "reducer": reducer})
+
+    todo = []
+    for k in range(len(shards)):
+        p = _shard_path(ckpt, k)
+        if os.path.exists(p) and not (retry_errors and _read_json(p)["errors"]): continue
+        todo.append(k)
+    if len(todo) < len(shards): _log(f"checkpoint: {len(shards) - len(todo)} parça hazır, {len(todo)} kaldı")
+
+    def shard_args(k):   # parça verisi gönderilirken kurulur (hepsi birden bellekte tutulmaz)
+        return (k, shards[k], store.geoms[store.index(shards[k])], dates, backend, reducer,
+                series, workers, _shard_path(ckpt, k))
+    done = len(shards) - len(todo)
+    def report(r):
+        nonlocal done
+        done += 1; k, n, errs, secs = r
+        _log(f"parça {k + 1}/{len(shards)} ✓ {n} parsel·tarih, {secs:.1f} s"
+             + (f" — {len(errs)} hata" if errs else "") + f" [{done}/{len(shards)}]")
+    if processes <= 1:
+        for k in todo: report(run_shard(*shard_args(k)))
+    elif todo:
+        # spawn: her süreç app'i temiz içe aktarır (iş parçacığı + fork karışmaz)
+        # Kuyrukta en çok 2×süreç parça bekler; biri bitince sıradaki gönderilir
+        with ProcessPoolExecutor(processes, mp_context=mp.get_context("spawn"),
+                                 initializer=_quiet) as pool:
+            it = iter(todo); pending = set()
+            while True:
+                for k in it:
+                    pending.add(pool.submit(run_shard, *shard_args(k)))
+                    if len(pending) >= 2 * processes: break
+                if not pending: break
+                fin, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in fin: report(fut.result())
+
+    res, errors = collect(store, ckpt, len(shards))
+    writer = getattr(app, WRITERS[ext])
+    cols, parts = app.report_chunks(kind, store, ids, res, dates)
+    extra = {".xlsx": app.REPORT_SHEETS[kind], ".parquet": (store.aidx.kinds,)}.get(ext, ())
+    buf = writer(cols, parts, *extra)
+    tmp = f"{out}.tmp"
+    with open(tmp, "wb") as fh: fh.write(buf.getbuffer())
+    os.replace(tmp, out)
+    _log(f"rapor yazıldı: {out}" + (f" — {len(errors)} hata" if errors else ""))
+    return {"out": out, "shards": len(shards), "ran": len(todo), "errors": errors}
+
+def collect(store, ckpt, n_shards):
+    """Checkpoint parçaları → NdviResults (+ tekilleştirilmiş hata listesi)"""
+    res = app.NdviResults(store.ids); errors = {}
+    for k in range(n_shards):
+        sh = _read_json(_shard_path(ckpt, k))
+        for e in sh["errors"]: errors.setdefault(e, None)
+        by = {}
+        for fid, date, val, actual in sh["rows"]:
+            by.setdefault((date, actual), {})[fid] = val
+        for (date, actual), vals in by.items(): res.put(date, vals, actual)
+    return res, list(errors)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="AgroSense toplu NDVI çalıştırıcı (Streamlit'siz)")
+    ap.add_argument("parcels", help="parsel dosyası: .zip (SHP) / .kml / .kmz / .geojson")
+    ap.add_argument("-d", "--dates", required=True,
+                    help="2024-06-01,2024-07-15 | 2024-03-01:2024-09-01:15 | @dosya.txt")
+    ap.add_argument("-o", "--out", required=True, help="çıktı: .xlsx / .csv / .parquet")
+    ap.add_argument("--kind", choices=["rows", "ts"], default="rows",
+                    help="rows: parsel bazlı, ts: zaman serisi (uzun format)")
+    ap.add_argument("--backend", choices=list(app.NDVI_BACKENDS), default="openeo")
+    ap.add_argument("--reducer", default="mean", choices=app.ZONAL_REDUCERS)
+    ap.add_argument("--no-series", action="store_true", help="tarih başına ayrı execute")
+    ap.add_argument("-p", "--processes", type=int, default=1, help="paralel süreç sayısı")
+    ap.add_argument("-w", "--workers", type=int, default=app.OPENEO_WORKERS,
+                    help="süreç başına paralel OpenEO işi")
+    ap.add_argument("--shard-size", type=int, default=SHARD_SIZE)
+    ap.add_argument("--checkpoint", help="checkpoint klasörü (varsayılan: <out>.ckpt)")
+    ap.add_argument("--where", action="append", default=[], metavar="SÜTUN=D1,D2",
+                    help="öznitelik filtresi (tekrarlanabilir, AND)")
+    ap.add_argument("--retry-errors", action="store_true", help="hatalı parçaları yeniden çalıştır")
+    ap.add_argument("--fresh", action="store_true", help="uyumsuz checkpoint'i sil, baştan başla")
+    a = ap.parse_args(argv)
+    try:
+        r = run_batch(a.parcels, parse_dates(a.dates), a.out, a.kind, a.backend, a.reducer,
+                      not a.no_series, a.processes, a.workers, a.shard_size, a.checkpoint,
+                      a.where, a.retry_errors, a.fresh)
+    except ValueError as e:
+        ap.error(str(e))   # kullanım hatası → çıkış kodu 2
+    for e in r["errors"]: _log(f"⚠ {e}")
+    return 1 if r["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
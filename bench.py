@@ -0,0 +1,430 @@
+"""
+AgroSense — tekrarlanabilir performans ölçümü
+- Yerel STAC + openEO taklit sunucusu (ayarlı gecikme, deterministik yanıtlar; ağ yok)
+- Sentetik parsel üreticileri: GeoJSON / KML / KMZ / SHP (zip), 1k–100k poligon
+- Senaryolar: ingest, STAC, openEO, yanıt ayrıştırma, analiz, harita, export
+- Her senaryo ayrı süreçte çalışır: süre (en iyi tekrar) + çalıştırma süresince tepe bellek (tracemalloc, RSS)
+
+Örnek:
+    python bench.py                                   # 1k, 10k — tüm senaryolar
+    python bench.py -n 1000,10000,100000 -s ingest,map --json sonuc.json
+    python bench.py --baseline onceki.json            # %20'den fazla yavaşlama → çıkış kodu 1
+    python bench.py --serve                           # sadece taklit sunucuları (elle deneme)
+"""
+import argparse, json, os, sys, time, math, zlib, io, zipfile, tempfile, logging, threading
+import multiprocessing as mp
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, timedelta
+
+import numpy as np
+
+DATA_DIR  = os.environ.get("AGROSENSE_BENCH_DATA", os.path.join(tempfile.gettempdir(), "agrosense_bench"))
+FORMATS   = ("geojson", "kml", "kmz", "shp")
+IL        = ["Konya", "Aksaray", "Karaman", "Niğde", "Eskişehir"]
+DATES     = ["2024-04-01", "2024-04-20", "2024-05-10", "2024-06-01", "2024-06-20", "2024-07-15"]
+REVISIT   = 5      # taklit STAC: her 5 günde bir sahne
+STAC_PAGE = 20     # taklit STAC sayfa boyu (sayfalama yolu da ölçülür)
+
+# ── Sentetik parseller ────────────────────────────────────────
+def gen_parcels(n, seed=0, verts=(6, 24)):
+    """
+    Konya ovasında ızgaraya yayılmış düzensiz (yıldız biçimli, geçerli) parseller.
+    Returns: GeoJSON Feature listesi — aynı (n, seed) her zaman aynı çıktı.
+    """
+    rng = np.random.default_rng(seed)
+    side = int(math.ceil(math.sqrt(n))); step = 0.004   # ≈ 350 m
+    out = []
+    for i in range(n):
+        cx = 32.3 + (i % side) * step + rng.uniform(-4e-4, 4e-4)
+        cy = 37.8 + (i // side) * step + rng.uniform(-4e-4, 4e-4)
+        k  = int(rng.integers(*verts))
+        a  = (np.arange(k) + rng.uniform(0, 0.7, k)) * 2 * math.pi / k   # artan açılar → basit halka
+        r  = rng.uniform(8e-4, 1.6e-3, k)
+        ring = np.round(np.c_[cx + r * np.cos(a), cy + 0.8 * r * np.sin(a)], 7).tolist()
+        ring.append(ring[0])
+        out.append({"type": "Feature",
+                    "properties": {"ad": f"Tarla {i}", "il": IL[i % len(IL)],
+                                   "ada": i // 50, "parsel": i % 50 + 1},
+                    "geometry": {"type": "Polygon", "coordinates": [ring]}})
+    return out
+
+def _kml(feats):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n'
+    for f in feats:
+        p = f["properties"]
+        data = "".join(f'<Data name="{k}"><value>{v}</value></Data>' for k, v in p.items())
+        coords = " ".join(f"{x},{y},0" for x, y in f["geometry"]["coordinates"][0])
+        yield (f"<Placemark><name>{p['ad']}</name><ExtendedData>{data}</ExtendedData>"
+               f"<Polygon><outerBoundaryIs><LinearRing><coordinates>{coords}</coordinates>"
+               f"</LinearRing></outerBoundaryIs></Polygon></Placemark>\n")
+    yield "</Document></kml>\n"
+
+def _shp_zip(feats, path):
+    import shapefile as sf
+    shp, shx, dbf = io.BytesIO(), io.BytesIO(), io.BytesIO()
+    w = sf.Writer(shp=shp, shx=shx, dbf=dbf, shapeType=sf.POLYGON, encoding="utf-8")
+    w.field("ad", "C", 40); w.field("il", "C", 20); w.field("ada", "N", 8); w.field("parsel", "N", 4)
+    for f in feats:
+        p = f["properties"]
+        # shapefile dış halka saat yönünde
+        w.poly([f["geometry"]["coordinates"][0][::-1]]); w.record(p["ad"], p["il"], p["ada"], p["parsel"])
+    w.close()
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        for ext, b in (("shp", shp), ("shx", shx), ("dbf", dbf)): z.writestr(f"parseller.{ext}", b.getvalue())
+        z.writestr("parseller.cpg", "UTF-8")
+
+def parcel_file(n, fmt, seed=0, root=DATA_DIR):
+    """Sentetik parsel dosyası (önbellekli) → yol"""
+    os.makedirs(root, exist_ok=True)
+    ext = {"shp": "zip"}.get(fmt, fmt)
+    path = os.path.join(root, f"parseller_{n}_{seed}.{ext}")
+    if os.path.exists(path): return path
+    feats = gen_parcels(n, seed); tmp = f"{path}.tmp"
+    if fmt == "geojson":
+        with open(tmp, "w", encoding="utf-8") as fh: json.dump({"type": "FeatureCollection", "features": feats}, fh)
+    elif fmt == "kml":
+        with open(tmp, "w", encoding="utf-8") as fh: fh.writelines(_kml(feats))
+    elif fmt == "kmz":
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as z: z.writestr("doc.kml", "".join(_kml(feats)))
+    elif fmt == "shp":
+        _shp_zip(feats, tmp)
+    else: raise ValueError(fmt)
+    os.replace(tmp, path)
+    return path
+
+# ── Taklit STAC + openEO sunucusu ─────────────────────────────
+def fake_ndvi(fid, date):
+    """Parsel·tarih başına deterministik NDVI (0.05–0.85)"""
+    return round(0.05 + (zlib.crc32(f"{fid}|{date}".encode()) % 800) / 1000, 4)
+
+def _scene_days(start, end):
+    d0 = datetime(2024, 1, 1); s = datetime.strptime(start[:10], "%Y-%m-%d")
+    e = datetime.strptime(end[:10], "%Y-%m-%d")
+    k = max(0, math.ceil((s - d0).days / REVISIT)); out = []
+    while (d := d0 + timedelta(days=k * REVISIT)) <= e:
+        out.append(d.strftime("%Y-%m-%d")); k += 1
+    return out
+
+class StandIn(ThreadingHTTPServer):
+    """
+    Tek HTTP sunucusunda: /token (CDSE kimlik), /stac/search (sayfalı POST),
+    /openeo/... (keşif, OIDC client-credentials, koleksiyon, POST /result).
+    Gecikmeler saniye; openEO gecikmesi + parsel başına ms.
+    """
+    daemon_threads = True
+    def __init__(self, stac_latency=0.0, openeo_latency=0.0, per_feature_ms=0.0, port=0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.stac_latency, self.openeo_latency, self.per_feature_ms = stac_latency, openeo_latency, per_feature_ms
+        self.base = f"http://127.0.0.1:{self.server_address[1]}"
+        self.hits = {}
+
+def _graph_node(pg, pid):
+    return next((n["arguments"] for n in pg.values() if n.get("process_id") == pid), None)
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *a): pass
+
+    def _send(self, obj, code=200):
+        b = json.dumps(obj).encode()
+        self.send_response(code); self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(b))); self.end_headers(); self.wfile.write(b)
+
+    def _body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(n) if n else b""
+        try: return json.loads(raw or b"{}")
+        except ValueError: return {}
+
+    def _count(self, key):
+        self.server.hits[key] = self.server.hits.get(key, 0) + 1
+
+    def do_GET(self):
+        b, p = self.server.base, self.path.split("?")[0].rstrip("/")
+        oe = f"{b}/openeo"
+        if p == "/openeo/.well-known/openeo":
+            return self._send({"versions": [{"url": oe, "api_version": "1.2.0", "production": True}]})
+        if p == "/openeo":
+            eps = [{"path": q, "methods": m} for q, m in (
+                ("/collections", ["GET"]), ("/collections/{collection_id}", ["GET"]),
+                ("/credentials/oidc", ["GET"]), ("/result", ["POST"]))]
+            return self._send({"api_version": "1.2.0", "backend_version": "bench", "stac_version": "1.0.0",
+                               "id": "bench", "title": "bench", "description": "", "endpoints": eps, "links": []})
+        if p == "/openeo/credentials/oidc":
+            return self._send({"providers": [{"id": "bench", "issuer": f"{b}/oidc", "title": "bench",
+                                              "scopes": ["openid"]}]})
+        if p == "/oidc/.well-known/openid-configuration":
+            return self._send({"issuer": f"{b}/oidc", "token_endpoint": f"{b}/token",
+                               "authorization_endpoint": f"{b}/oidc/auth", "scopes_supported": ["openid"],
+                               "grant_types_supported": ["client_credentials"]})
+        if p.startswith("/openeo/collections/"):
+            cid = p.rsplit("/", 1)[-1]
+            return self._send({"id": cid, "stac_version": "1.0.0", "description": "", "license": "proprietary",
+                               "extent": {"spatial": {"bbox": [[-180, -90, 180, 90]]},
+                                          "temporal": {"interval": [["2015-06-23T00:00:00Z", None]]}},
+                               "cube:dimensions": {"x": {"type": "spatial", "axis": "x"},
+                                                   "y": {"type": "spatial", "axis": "y"},
+                                                   "t": {"type": "temporal"},
+                                                   "bands": {"type": "bands", "values": ["B04", "B08"]}},
+                               "summaries": {"eo:bands": [{"name": "B04"}, {"name": "B08"}]}, "links": []})
+        if p == "/openeo/collections":
+            return self._send({"collections": [], "links": []})
+        self._send({"code": "NotFound", "message": p}, 404)
+
+    def do_POST(self):
+        p = self.path.split("?")[0].rstrip("/")
+        body = self._body()
+        if p == "/token":
+            return self._send({"access_token": "bench", "token_type": "Bearer", "expires_in": 3600})
+        if p == "/stac/search":
+            self._count("stac"); time.sleep(self.server.stac_latency)
+            start, end = body.get("datetime", "2024-01-01/2024-01-31").split("/")
+            days = _scene_days(start, end)
+            page = int(body.get("page", 1)); size = min(int(body.get("limit", STAC_PAGE)), STAC_PAGE)
+            chunk = days[(page - 1) * size: page * size]
+            feats = [{"type": "Feature", "id": f"S2_{d}",
+                      "properties": {"datetime": f"{d}T08:30:00Z",
+                                     "eo:cloud_cover": zlib.crc32(d.encode()) % 100}} for d in chunk]
+            links = ([{"rel": "next", "href": f"{self.server.base}/stac/search", "method": "POST",
+                       "body": {"page": page + 1}, "merge": True}] if page * size < len(days) else [])
+            return self._send({"type": "FeatureCollection", "features": feats, "links": links})
+        if p == "/openeo/result":
+            self._count("openeo")
+            pg = body.get("process", {}).get("process_graph", {})
+            geoms = (_graph_node(pg, "aggregate_spatial") or {}).get("geometries", {})
+            fids = [f.get("id") for f in geoms.get("features", [])]
+            time.sleep(self.server.openeo_latency + len(fids) * self.server.per_feature_ms / 1000)
+            temporal = _graph_node(pg, "aggregate_temporal")
+            if temporal:
+                return self._send({f"{d}T00:00:00Z": [[fake_ndvi(f, d)] for f in fids]
+                                   for d in temporal.get("labels", [])})
+            lc = _graph_node(pg, "load_collection") or {}
+            d = (lc.get("temporal_extent") or ["2024-01-01"])[0]
+            return self._send([[fake_ndvi(f, d)] for f in fids])
+        self._send({"code": "NotFound", "message": p}, 404)
+
+def serve(stac_latency=0.0, openeo_latency=0.0, per_feature_ms=0.0, port=0):
+    """Sunucuyu arka iş parçacığında başlat → StandIn (srv.base, srv.hits)"""
+    srv = StandIn(stac_latency, openeo_latency, per_feature_ms, port)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+def point_app(app, base):
+    """app'in uç noktalarını taklit sunucuya çevir (çağrı anında okunan modül sabitleri)"""
+    app.CDSE_TOKEN_URL = f"{base}/token"
+    app.CDSE_STAC      = f"{base}/stac/search"
+    app.OPENEO_URL     = f"{base}/openeo"
+
+# ── Senaryolar ────────────────────────────────────────────────
+# Her senaryo: setup(app, n, ctx) → ölçülecek argümansız fonksiyon. setup süresi ölçülmez.
+def _store(app, n):
+    with open(parcel_file(n, "geojson"), "rb") as fh:
+        return app.ParcelStore.from_features(app.iter_file(fh))
+
+def _ingest(fmt):
+    def setup(app, n, ctx):
+        path = parcel_file(n, fmt)
+        def run():
+            with open(path, "rb") as fh: app.ParcelStore.from_features(app.iter_file(fh))
+        return run
+    return setup
+
+def _stac_resolve(app, n, ctx):
+    s = _store(app, n); bbox = s.total_bounds()
+    def run():
+        app.scene_cache().clear(); app.resolve_scenes(bbox, DATES)
+    return run
+
+def _stac_nearest(app, n, ctx):
+    s = _store(app, n); bbox = s.total_bounds()
+    def run():
+        app.scene_cache().clear()
+        for d in DATES: app.find_nearest_scene(bbox, d)
+    return run
+
+def _openeo_date(app, n, ctx):
+    s = _store(app, n); feats = s.features(s.ids)
+    return lambda: app.fetch_ndvi_for_date(feats, "2024-06-01")
+
+def _openeo_series(app, n, ctx):
+    s = _store(app, n); feats = s.features(s.ids)
+    return lambda: app.fetch_ndvi_timeseries(feats, DATES)
+
+def _parse(app, n, ctx):
+    feats = [{"id": str(i)} for i in range(n)]
+    raw = {f"{d}T00:00:00Z": [[fake_ndvi(str(i), d)] for i in range(n)] for d in DATES}
+    return lambda: app.parse_openeo_response(raw, feats, by_date=True)
+
+def _analysis(app, n, ctx):
+    s = _store(app, n); idx = np.arange(len(s))
+    def run():
+        app.get_ndvi_cache().clear(); app.ndvi_mem_cache().clear(); app.scene_cache().clear()
+        for _ in app.run_analysis(s, [(d, idx) for d in DATES], True, app.OPENEO_WORKERS, "openeo"): pass
+    return run
+
+def _results(app, s):
+    res = app.NdviResults(s.ids)
+    for d in DATES: res.put(d, {f: fake_ndvi(f, d) for f in s.ids}, d)
+    return res
+
+def _map(detail):
+    def setup(app, n, ctx):
+        s = _store(app, n); res = _results(app, s); b = s.total_bounds()
+        cx, cy = (b[0] + b[2]) / 2, (b[1] + b[3]) / 2
+        # detay: ~zoom 15 görünümü; özet: tüm katman zoom 10
+        view = (cx - 0.02, cy - 0.01, cx + 0.02, cy + 0.01, 15) if detail else (*b, 10)
+        def run():
+            fg, _ = app.parcel_layer(s, s.ids[:50], DATES[0], res, app.layer_view(view))
+            m = app.build_map(DATES[0], [cy, cx], view[-1]); m.add_child(fg)
+            m.get_root().render()
+        return run
+    return setup
+
+def _export(fmt):
+    def setup(app, n, ctx):
+        s = _store(app, n); res = _results(app, s)
+        writer = getattr(app, f"to_{fmt}")
+        return lambda: writer(*app.report_chunks("ts", s, s.ids, res, DATES))
+    return setup
+
+SCENARIOS = {
+    **{f"ingest.{f}": _ingest(f) for f in FORMATS},
+    "stac.resolve":   _stac_resolve,
+    "stac.nearest":   _stac_nearest,
+    "openeo.date":    _openeo_date,
+    "openeo.series":  _openeo_series,
+    "parse.openeo":   _parse,
+    "analysis":       _analysis,
+    "map.detail":     _map(True),
+    "map.summary":    _map(False),
+    **{f"export.{f}": _export(f) for f in ("csv", "xlsx", "parquet")},
+}
+
+def _proc_mb(key):
+    with open("/proc/self/status") as fh:
+        for line in fh:
+            if line.startswith(key): return int(line.split()[1]) / 1024
+
+def _reset_peak():
+    """Linux: tepe RSS (VmHWM) sıfırlanır → True; desteklenmiyorsa False"""
+    try:
+        with open("/proc/self/clear_refs", "w") as fh: fh.write("5")
+        return True
+    except OSError:
+        return False
+
+def _measure(run, repeat):
+    """
+    (en iyi süre, tepe MB, tepe RSS MB | None) — bellek yalnızca run() süresince:
+    - tepe: süreye katılmayan ek bir tekrar tracemalloc altında (Python + numpy
+      ayırmaları; setup'ta serbest kalan yığının yeniden kullanımı bunu gizlemez)
+    - tepe RSS: Linux'ta her tekrar öncesi VmHWM sıfırlanır (C kütüphaneleri dahil)
+    """
+    import tracemalloc
+    best = None; rss = None
+    for _ in range(repeat):
+        if _reset_peak(): base = _proc_mb("VmRSS")
+        else: base = None
+        t0 = time.perf_counter(); run(); dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+        if base is not None: rss = max(rss or 0.0, _proc_mb("VmHWM") - base)
+    tracemalloc.start(); run()
+    peak = tracemalloc.get_traced_memory()[1] / 2**20; tracemalloc.stop()
+    return best, peak, rss
+
+def _child(name, n, repeat, cfg, cache_dir):
+    """Ayrı süreçte: app içe aktar, taklit sunucu, setup, ölç"""
+    os.environ["AGROSENSE_CACHE"] = os.path.join(cache_dir, f"{name}_{n}.sqlite")
+    import app
+    for lg in list(logging.root.manager.loggerDict):   # bare mode uyarıları
+        if lg.startswith("streamlit"): logging.getLogger(lg).setLevel(logging.ERROR)
+    srv = serve(**cfg); point_app(app, srv.base)
+    run = SCENARIOS[name](app, n, {})
+    best, peak, rss = _measure(run, repeat)
+    srv.shutdown()
+    return {"scenario": name, "n": n, "secs": round(best, 4), "peak_mb": round(peak, 1),
+            "rss_mb": None if rss is None else round(max(0.0, rss), 1), "requests": srv.hits}
+
+def run_suite(sizes, names, repeat=1, cfg=None, log=print):
+    """Tüm (senaryo, n) çiftleri — her biri temiz bir süreçte (spawn)"""
+    cfg = cfg or {}; out = []
+    ctx = mp.get_context("spawn")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for n in sizes:
+            for fmt in FORMATS: parcel_file(n, fmt)      # veri üretimi ölçüme girmez
+            for name in names:
+                with ctx.Pool(1) as pool:
+                    try: r = pool.apply(_child, (name, n, repeat, cfg, cache_dir))
+                    except Exception as e:
+                        r = {"scenario": name, "n": n, "secs": None, "peak_mb": None, "rss_mb": None,
+                             "error": str(e)[:200]}
+                out.append(r); log(_fmt_row(r))
+    return out
+
+# ── Rapor / karşılaştırma ─────────────────────────────────────
+def _fmt_row(r, ref=None):
+    if r.get("secs") is None: return f"{r['scenario']:<16}{r['n']:>8}   HATA: {r.get('error')}"
+    rss = "—" if r.get("rss_mb") is None else f"{r['rss_mb']:.1f}"
+    line = f"{r['scenario']:<16}{r['n']:>8}{r['secs']:>10.3f} s{r['peak_mb']:>9.1f} MB{rss:>9} MB"
+    if ref and ref.get("secs"):
+        line += f"   ×{r['secs'] / ref['secs']:.2f} (önce {ref['secs']:.3f} s)"
+    return line
+
+def compare(results, baseline, tol=0.2):
+    """Önceki JSON ile karşılaştır → (satırlar, yavaşlayanlar)"""
+    ref = {(r["scenario"], r["n"]): r for r in baseline}
+    lines, slow = [], []
+    for r in results:
+        b = ref.get((r["scenario"], r["n"]))
+        lines.append(_fmt_row(r, b))
+        if b and b.get("secs") and r.get("secs") and r["secs"] > b["secs"] * (1 + tol):
+            slow.append(r)
+    return lines, slow
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="AgroSense performans ölçümü (taklit STAC/openEO ile)")
+    ap.add_argument("-n", "--sizes", default="1000,10000", help="parsel sayıları (virgülle)")
+    ap.add_argument("-s", "--scenarios", default="",
+                    help="senaryo ön ekleri (virgülle), ör. ingest,map — boş: hepsi")
+    ap.add_argument("-r", "--repeat", type=int, default=1, help="tekrar sayısı (en iyi süre)")
+    ap.add_argument("--stac-latency", type=float, default=0.05, help="STAC istek gecikmesi (s)")
+    ap.add_argument("--openeo-latency", type=float, default=0.2, help="openEO execute gecikmesi (s)")
+    ap.add_argument("--per-feature-ms", type=float, default=0.0, help="openEO parsel başına ek gecikme (ms)")
+    ap.add_argument("--json", help="sonuçları JSON'a yaz")
+    ap.add_argument("--baseline", help="önceki JSON ile karşılaştır")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="kabul edilen yavaşlama oranı")
+    ap.add_argument("--serve", action="store_true", help="sadece taklit sunucuları çalıştır")
+    ap.add_argument("--port", type=int, default=8765)
+    a = ap.parse_args(argv)
+    cfg = {"stac_latency": a.stac_latency, "openeo_latency": a.openeo_latency,
+           "per_feature_ms": a.per_feature_ms}
+    if a.serve:
+        srv = serve(port=a.port, **cfg)
+        print(f"taklit sunucu: {srv.base}  (AGROSENSE: token={srv.base}/token "
+              f"stac={srv.base}/stac/search openeo={srv.base}/openeo) — Ctrl+C ile çık")
+        try:
+            while True: time.sleep(3600)
+        except KeyboardInterrupt: return 0
+    sizes = [int(x) for x in a.sizes.split(",") if x.strip()]
+    pre = [p.strip() for p in a.scenarios.split(",") if p.strip()]
+    names = [s for s in SCENARIOS if not pre or any(s.startswith(p) for p in pre)]
+    if not names: raise SystemExit(f"Senaryo yok. Seçenekler: {', '.join(SCENARIOS)}")
+    print(f"{'senaryo':<16}{'n':>8}{'süre':>12}{'tepe':>12}{'tepe RSS':>12}")
+    results = run_suite(sizes, names, a.repeat, cfg)
+    if a.json:
+        with open(a.json, "w", encoding="utf-8") as fh:
+            json.dump({"when": datetime.now().isoformat(timespec="seconds"), "config": cfg,
+                       "results": results}, fh, ensure_ascii=False, indent=1)
+    if a.baseline:
+        with open(a.baseline, encoding="utf-8") as fh: prev = json.load(fh)
+        if prev.get("config") != cfg: print(f"\n⚠ gecikme ayarları farklı: önce {prev.get('config')}")
+        lines, slow = compare(results, prev["results"], a.tolerance)
+        print("\nkarşılaştırma:"); print("\n".join(lines))
+        if slow:
+            print(f"\n⚠ {len(slow)} senaryo %{a.tolerance * 100:.0f}'den fazla yavaşladı")
+            return 1
+    return 1 if any(r.get("secs") is None for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
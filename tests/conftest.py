@@ -0,0 +1,5 @@
+import logging, os, sys
+
+# app.py depo kökünde; Streamlit'siz içe aktarılır (batch.py ile aynı)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.getLogger("streamlit").setLevel(logging.ERROR)
@@ -0,0 +1,38 @@
+import io, zipfile
+
+import pytest
+
+import app
+
+KML = """<?xml version="1.0" encoding="{enc}"?>
+<kml xmlns="http://www.opengis.net/kml/2.2"><Document><Placemark>
+<name>Şişli</name>
+<Polygon><outerBoundaryIs><LinearRing>
+<coordinates>29,41 29.01,41 29.01,41.01 29,41.01 29,41</coordinates>
+</LinearRing></outerBoundaryIs></Polygon>
+</Placemark></Document></kml>"""
+
+
+def _names(feats):
+    return [f["props"].get("name") for f in feats]
+
+
+@pytest.mark.parametrize("enc", ["windows-1254", "ISO-8859-9", "UTF-8"])
+def test_declared_encoding_round_trips(enc):
+    data = KML.format(enc=enc).encode(enc)
+    assert _names(app.iter_kml(data)) == ["Şişli"]
+
+
+def test_declared_encoding_in_kmz_member():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("doc.kml", KML.format(enc="windows-1254").encode("cp1254"))
+    with zipfile.ZipFile(buf) as z, z.open("doc.kml") as fh:
+        assert _names(app.iter_kml(fh)) == ["Şişli"]
+
+
+def test_bad_bytes_are_replaced():
+    # UTF-8 bildirip cp1254 yazılmış dosya düşmez
+    data = KML.format(enc="UTF-8").encode("cp1254")
+    feats = list(app.iter_kml(data))
+    assert len(feats) == 1 and "�" in feats[0]["props"]["name"]
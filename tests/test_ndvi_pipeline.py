@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+import app
+
+FEATS = [{"id": "a"}, {"id": "b"}]
+
+
+def _scene(date, cc):
+    return {"properties": {"datetime": f"{date}T08:36:01Z", "eo:cloud_cover": cc}}
+
+
+def test_parse_by_date_keeps_only_returned_dates():
+    raw = {"2024-06-01T00:00:00Z": [[0.41], [0.72]],
+           "2024-06-11T00:00:00Z": [[None], [2.5]]}
+    out = app.parse_openeo_response(raw, FEATS, by_date=True)
+    assert out == {"2024-06-01": {"a": 0.41, "b": 0.72},
+                   "2024-06-11": {"a": None, "b": None}}
+    assert "2024-06-21" not in out
+
+
+def test_parse_list_shaped_response():
+    assert app.parse_openeo_response([[0.3], [0.5]], FEATS) == {"a": 0.3, "b": 0.5}
+    assert app.parse_openeo_response([0.3, 0.5], FEATS) == {"a": 0.3, "b": 0.5}
+    assert app.parse_openeo_response([[0.3]], FEATS) == {"a": 0.3, "b": None}
+    assert app.parse_openeo_response([[0.3], [0.5]], FEATS, by_date=True) == {}
+
+
+def test_timeseries_missing_date_is_blank(monkeypatch):
+    class Cube:
+        def aggregate_temporal(self, **k): return self
+        def aggregate_spatial(self, **k): return self
+        def execute(self): return {"2024-06-01T00:00:00Z": [[0.4], [0.6]]}
+    monkeypatch.setattr(app, "_ndvi_cube", lambda *a: (Cube(), {}))
+    out = app.fetch_ndvi_timeseries(FEATS, ["2024-06-01", "2024-06-11"])
+    assert out == {"2024-06-01": {"a": 0.4, "b": 0.6}, "2024-06-11": {"a": None, "b": None}}
+
+
+def test_timeseries_unparseable_response_raises(monkeypatch):
+    class Cube:
+        def aggregate_temporal(self, **k): return self
+        def aggregate_spatial(self, **k): return self
+        def execute(self): return [[0.4], [0.6]]
+    monkeypatch.setattr(app, "_ndvi_cube", lambda *a: (Cube(), {}))
+    with pytest.raises(RuntimeError):
+        app.fetch_ndvi_timeseries(FEATS, ["2024-06-01", "2024-06-11"])
+
+
+def test_pick_nearest_tie_prefers_lower_cloud_cover():
+    items = [_scene("2024-06-05", 30), _scene("2024-06-15", 10), _scene("2024-07-30", 0)]
+    date, item = app.pick_nearest(items, "2024-06-10")
+    assert date == "2024-06-15" and item is items[1]
+    assert app.pick_nearest(items, "2024-06-02")[0] == "2024-06-05"
+    assert app.pick_nearest(items, "2024-09-01") == (None, None)
+
+
+def test_group_jobs_mixed_dates():
+    a, b = np.array([3, 1, 2]), np.array([7])
+    to_do = [("2024-06-01", a), ("2024-06-03", np.array([1, 2, 3])),
+             ("2024-06-20", a), ("2024-06-01", b), ("2024-08-01", a)]
+    scenes = {"2024-06-01": ("2024-06-02", {}), "2024-06-03": ("2024-06-02", {}),
+              "2024-06-20": ("2024-06-19", {}), "2024-08-01": (None, None)}
+
+    jobs, empty = app.group_jobs(to_do, scenes, series=True)
+    assert [(sorted(m.tolist()), plan) for m, plan in jobs] == [
+        ([1, 2, 3], {"2024-06-02": ["2024-06-01", "2024-06-03"], "2024-06-19": ["2024-06-20"]}),
+        ([7], {"2024-06-02": ["2024-06-01"]})]
+    assert [(d, m.tolist()) for d, m in empty] == [("2024-08-01", [3, 1, 2])]
+
+    jobs, _ = app.group_jobs(to_do, scenes, series=False)
+    assert [plan for _, plan in jobs] == [
+        {"2024-06-02": ["2024-06-01", "2024-06-03"]}, {"2024-06-19": ["2024-06-20"]},
+        {"2024-06-02": ["2024-06-01"]}]
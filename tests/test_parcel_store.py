@@ -0,0 +1,26 @@
+import app
+
+
+def _square(x):
+    return {"type": "Polygon", "coordinates": [[[x, 0], [x + 1, 0], [x + 1, 1], [x, 1], [x, 0]]]}
+
+
+def _store(props):
+    fc = {"type": "FeatureCollection",
+          "features": [{"type": "Feature", "properties": p, "geometry": _square(i)}
+                       for i, p in enumerate(props)]}
+    return app.ParcelStore.from_features(app.parse_geojson(fc))
+
+
+def test_features_without_attributes():
+    s = _store([None, None, None])
+    assert len(s.attrs.columns) == 0
+    assert s.records(s.index(s.ids)) == [{}, {}, {}]
+    feats = s.features(s.ids)
+    assert [f["id"] for f in feats] == s.ids
+    assert all(f["props"] == {} and f["geom"]["type"] == "Polygon" for f in feats)
+
+
+def test_features_keep_present_attributes():
+    s = _store([{"ad": "A", "il": None}, {"ad": "B", "il": "Konya"}])
+    assert [f["props"] for f in s.features(["1", "0"])] == [{"ad": "B", "il": "Konya"}, {"ad": "A"}]